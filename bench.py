@@ -0,0 +1,557 @@
+#####################################################################################
+#####################################################################################
+#####################################################################################
+# SHOPSNITCH BENCHMARKS
+#
+# run with:   python bench.py                     (10k rows, quick)
+#             python bench.py --sizes 10k,1m,10m  (the full set, takes a while)
+#             python bench.py --save-baseline     (accept the current numbers)
+#
+# everything runs offline: the history comes from synthetic chromium databases and
+# browser_history and the brevo sdk are replaced with small stand-ins
+#
+# every check prints what it measured and the whole run exits with 1 if anything
+# went over its budget or got slower than the stored baseline, so a slow change
+# fails loudly instead of quietly
+#####################################################################################
+#####################################################################################
+#####################################################################################
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from datetime import datetime, timezone
+from pathlib import Path
+
+# THE FOLDER THIS FILE (AND main.py) LIVES IN
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# HOW LONG "import main" IS ALLOWED TO TAKE, IN MILLISECONDS
+IMPORT_BUDGET_MS = 50
+
+# THESE ARE ONLY ALLOWED TO BE LOADED BY THE CODE THAT USES THEM, NEVER ON IMPORT
+LAZY_MODULES = ["brevo_python", "browser_history", "dotenv", "smtplib", "ctypes"]
+
+# THE STORED NUMBERS EVERY RUN IS COMPARED AGAINST
+BASELINE_FILE = os.path.join(REPO_DIR, "bench_baseline.json")
+# HOW MUCH SLOWER THAN THE BASELINE A BENCHMARK MAY GET BEFORE IT FAILS
+# AND A FLOOR IN SECONDS SO TINY TIMINGS DO NOT FAIL ON NOISE
+BASELINE_TOLERANCE = 1.0
+BASELINE_FLOOR_SECONDS = 0.02
+
+# THE HISTORY SIZES THAT CAN BE BENCHMARKED
+SIZES = {"10k": 10000, "100k": 100000, "1m": 1000000, "10m": 10000000}
+# THE ALERT LIST SIZES EVERY HISTORY SIZE IS MATCHED AGAINST
+ALERT_LIST_SIZES = (1, 10, 100, 1000)
+
+# GENERATED DATABASES ARE KEPT HERE SO THE BIG ONES ARE ONLY BUILT ONCE
+# BUMP THE VERSION WHEN THE GENERATOR CHANGES
+FIXTURE_DIR = os.path.join(tempfile.gettempdir(), "shopsnitch-bench")
+FIXTURE_VERSION = 1
+# THE FIXTURES COVER THIS MANY DAYS OF BROWSING
+FIXTURE_DAYS = 30
+# CHROMIUM COUNTS MICROSECONDS FROM 1601
+CHROMIUM_EPOCH_OFFSET = 11644473600
+
+# SHOPPING SITES MIXED INTO THE SYNTHETIC HISTORY
+RETAILER_HOSTS = [
+    "www.amazon.com", "smile.amazon.com", "www.amazon.co.uk", "www.ebay.com", "www.etsy.com",
+    "www.walmart.com", "www.target.com", "www.bestbuy.com", "www.aliexpress.com", "www.wayfair.com",
+]
+RETAILER_NAMES = ["amazon", "ebay", "etsy", "walmart", "target", "bestbuy", "aliexpress", "wayfair"]
+# EVERYTHING ELSE PEOPLE VISIT
+COMMON_WORDS = [
+    "news", "mail", "docs", "video", "search", "weather", "sports", "recipes", "forum", "wiki",
+    "maps", "music", "travel", "bank", "school", "games", "photos", "blog", "jobs", "health",
+]
+
+
+#####################################################################################
+#####################################################################################
+#####################################################################################
+# STARTUP
+#####################################################################################
+#####################################################################################
+#####################################################################################
+
+#####################################################################################
+# THIS FUNCTION RUNS A SNIPPET IN A FRESH PYTHON AND RETURNS WHAT IT PRINTED
+# A FRESH INTERPRETER IS THE ONLY WAY TO MEASURE A COLD IMPORT
+#####################################################################################
+def run_python(arguments):
+    result = subprocess.run([sys.executable] + arguments, cwd=REPO_DIR,
+                            capture_output=True, text=True, check=True)
+    return result.stdout, result.stderr
+
+
+#####################################################################################
+# THIS FUNCTION RETURNS HOW LONG "import main" TOOK, IN MILLISECONDS
+# IT USES THE CUMULATIVE NUMBER FROM python -X importtime AND KEEPS THE FASTEST RUN
+#####################################################################################
+def measure_import_time(runs):
+    fastest = None
+    for _ in range(runs):
+        _, importtime_output = run_python(["-X", "importtime", "-c", "import main"])
+        for line in importtime_output.splitlines():
+            # import time: self [us] | cumulative | imported package
+            parts = line.split("|")
+            if len(parts) == 3 and parts[2].strip() == "main":
+                cumulative_ms = int(parts[1]) / 1000
+                if fastest is None or cumulative_ms < fastest:
+                    fastest = cumulative_ms
+    return fastest
+
+
+#####################################################################################
+# THIS FUNCTION RETURNS THE LAZY MODULES THAT "import main" LOADED ANYWAY
+# AND HOW MUCH MEMORY THE INTERPRETER NEEDED RIGHT AFTER THE IMPORT
+#####################################################################################
+def measure_cold_start():
+    output, _ = run_python(["-c", (
+        "import sys, resource, main\n"
+        "print(','.join(name for name in " + repr(LAZY_MODULES) + " if name in sys.modules))\n"
+        "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+    )])
+    loaded_line, memory_line = output.splitlines()
+    loaded = [name for name in loaded_line.split(",") if name]
+    # linux reports kilobytes
+    return loaded, int(memory_line) / 1024
+
+
+#####################################################################################
+# THIS FUNCTION CHECKS THE STARTUP COST OF main.py
+# IT RETURNS A LIST OF EVERYTHING THAT WENT OVER BUDGET
+#####################################################################################
+def bench_startup(import_budget_ms, runs):
+    failures = []
+
+    import_ms = measure_import_time(runs)
+    print("  [*] import main:        %.1f ms (budget %d ms)" % (import_ms, import_budget_ms))
+    if import_ms > import_budget_ms:
+        failures.append("import main took %.1f ms, the budget is %d ms" % (import_ms, import_budget_ms))
+
+    loaded, memory_mb = measure_cold_start()
+    print("  [*] cold start memory:  %.1f MB" % memory_mb)
+    if loaded:
+        failures.append("import main loaded " + ", ".join(loaded) + ", these must stay lazy")
+
+    return failures
+
+
+#####################################################################################
+#####################################################################################
+#####################################################################################
+# STAND-INS FOR THE BROWSER_HISTORY LIBRARY AND THE BREVO SDK
+#####################################################################################
+#####################################################################################
+#####################################################################################
+
+#####################################################################################
+# THIS FUNCTION MAKES browser_history FIND ONE CHROME PROFILE IN THE FIXTURE FOLDER
+# AND NOTHING ELSE, NO MATTER WHAT IS INSTALLED ON THIS MACHINE
+#####################################################################################
+def install_browser_history_stub(history_dir):
+    class BenchChrome:
+        name = "BenchChrome"
+        history_file = "History"
+
+        def profiles(self, profile_file):
+            return ["Default"]
+
+        def history_path_profile(self, profile_dir):
+            return Path(history_dir) / profile_dir / self.history_file
+
+    browser_history = types.ModuleType("browser_history")
+    utils = types.ModuleType("browser_history.utils")
+    utils.get_browsers = lambda: [BenchChrome]
+    browser_history.utils = utils
+    sys.modules["browser_history"] = browser_history
+    sys.modules["browser_history.utils"] = utils
+
+
+#####################################################################################
+# THIS FUNCTION REPLACES THE BREVO SDK WITH A STAND-IN THAT ACCEPTS EVERY EMAIL
+# IT RETURNS THE LIST THE "SENT" EMAILS END UP IN
+#####################################################################################
+def install_brevo_stub():
+    sent_emails = []
+
+    class Configuration:
+        def __init__(self):
+            self.api_key = {}
+
+    class ApiClient:
+        def __init__(self, configuration):
+            self.configuration = configuration
+
+    class TransactionalEmailsApi:
+        def __init__(self, api_client):
+            self.api_client = api_client
+
+        def send_transac_email(self, send_smtp_email):
+            sent_emails.append(send_smtp_email)
+
+    class SendSmtpEmail:
+        def __init__(self, **fields):
+            self.fields = fields
+
+    class ApiException(Exception):
+        pass
+
+    brevo_python = types.ModuleType("brevo_python")
+    rest = types.ModuleType("brevo_python.rest")
+    brevo_python.Configuration = Configuration
+    brevo_python.ApiClient = ApiClient
+    brevo_python.TransactionalEmailsApi = TransactionalEmailsApi
+    brevo_python.SendSmtpEmail = SendSmtpEmail
+    rest.ApiException = ApiException
+    brevo_python.rest = rest
+    sys.modules["brevo_python"] = brevo_python
+    sys.modules["brevo_python.rest"] = rest
+    return sent_emails
+
+
+#####################################################################################
+#####################################################################################
+#####################################################################################
+# SYNTHETIC HISTORY
+#####################################################################################
+#####################################################################################
+#####################################################################################
+
+#####################################################################################
+# THIS FUNCTION GENERATES (EPOCH SECONDS, URL, TITLE) VISITS, OLDEST FIRST
+# A FEW HOSTS GET MOST OF THE VISITS (ROUGHLY ZIPF, LIKE REAL BROWSING), AROUND ONE
+# VISIT IN TWENTY IS A SHOPPING SITE, AND SOME SEARCHES MENTION A SHOP BY NAME
+# SO THE TEXT AND HOST MATCHERS DISAGREE ON THEM
+#####################################################################################
+def generate_visits(row_count, seed, end_epoch):
+    generator = random.Random(seed)
+    hosts = ["www." + generator.choice(COMMON_WORDS) + str(i) + ".com" for i in range(2000)]
+    host_weights = [1 / (rank + 1) for rank in range(len(hosts))]
+    start_epoch = end_epoch - FIXTURE_DAYS * 86400
+    step = (end_epoch - start_epoch) / row_count
+
+    for i in range(row_count):
+        visit_time = start_epoch + i * step
+        roll = generator.random()
+        if roll < 0.05:
+            host = generator.choice(RETAILER_HOSTS)
+            path = "/dp/" + str(generator.randrange(10 ** 9))
+            title = host.split(".")[1].capitalize() + ".com: " + generator.choice(COMMON_WORDS) + " deals"
+        elif roll < 0.08:
+            host = "www.google.com"
+            path = "/search?q=" + generator.choice(RETAILER_NAMES) + "+" + generator.choice(COMMON_WORDS)
+            title = generator.choice(RETAILER_NAMES) + " " + generator.choice(COMMON_WORDS) + " - Google Search"
+        else:
+            host = generator.choices(hosts, host_weights)[0]
+            path = "/" + generator.choice(COMMON_WORDS) + "/" + str(generator.randrange(100000))
+            title = generator.choice(COMMON_WORDS).capitalize() + " " + str(i % 997)
+        yield visit_time, "https://" + host + path, title
+
+
+#####################################################################################
+# THIS FUNCTION BUILDS (OR REUSES) A CHROMIUM HISTORY DATABASE WITH row_count VISITS
+# IT RETURNS (HISTORY FOLDER, EPOCH OF THE LAST VISIT)
+#####################################################################################
+def build_history_fixture(row_count, seed):
+    history_dir = os.path.join(FIXTURE_DIR, "v%d-%d-%d" % (FIXTURE_VERSION, row_count, seed))
+    history_path = os.path.join(history_dir, "Default", "History")
+    meta_path = os.path.join(history_dir, "fixture.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            return history_dir, json.load(meta_file)["end_epoch"]
+
+    print("  [*] Building a " + format(row_count, ",") + " row history database (only done once)")
+    os.makedirs(os.path.dirname(history_path), exist_ok=True)
+    if os.path.exists(history_path):
+        os.remove(history_path)
+    end_epoch = float(int(time.time()))
+
+    connection = sqlite3.connect(history_path)
+    connection.executescript("""
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        CREATE TABLE urls (id INTEGER PRIMARY KEY, url TEXT, title TEXT, last_visit_time INTEGER);
+        CREATE TABLE visits (id INTEGER PRIMARY KEY, url INTEGER, visit_time INTEGER, visit_duration INTEGER);
+    """)
+    url_ids = {}
+    batch = []
+    for visit_time, url, title in generate_visits(row_count, seed, end_epoch):
+        chromium_time = int((visit_time + CHROMIUM_EPOCH_OFFSET) * 1000000)
+        url_id = url_ids.get(url)
+        if url_id is None:
+            url_id = len(url_ids) + 1
+            url_ids[url] = url_id
+            connection.execute("INSERT INTO urls VALUES (?, ?, ?, ?)", (url_id, url, title, chromium_time))
+        batch.append((url_id, chromium_time, 1))
+        if len(batch) == 100000:
+            connection.executemany("INSERT INTO visits (url, visit_time, visit_duration) VALUES (?, ?, ?)", batch)
+            batch = []
+    connection.executemany("INSERT INTO visits (url, visit_time, visit_duration) VALUES (?, ?, ?)", batch)
+    # the same index chromium has
+    connection.execute("CREATE INDEX visits_time_index ON visits (visit_time)")
+    connection.commit()
+    connection.close()
+
+    with open(meta_path, "w") as meta_file:
+        json.dump({"rows": row_count, "seed": seed, "end_epoch": end_epoch}, meta_file)
+    return history_dir, end_epoch
+
+
+#####################################################################################
+# THIS FUNCTION RETURNS AN ALERT LIST OF THE GIVEN SIZE
+# THE REAL SHOPS COME FIRST, THE REST ARE MADE UP NAMES THAT NEVER MATCH
+#####################################################################################
+def make_alert_list(size):
+    alert_list = RETAILER_NAMES[:size]
+    for i in range(size - len(alert_list)):
+        alert_list.append("shop" + str(i) + "x")
+    return alert_list
+
+
+#####################################################################################
+# THIS IS THE ORIGINAL find_alerts LOOP, KEPT HERE AS THE YARDSTICK
+# FOR THE COMPILED MATCHER (ONE "in" TEST PER SITE PER ROW)
+#####################################################################################
+def legacy_find_alerts(history_list, alert_site_list):
+    return_list = []
+    for history in history_list:
+        for alert_site in alert_site_list:
+            if alert_site in str(history[2]).lower():
+                return_list.append(alert_site)
+                break
+    return list(set(return_list))
+
+
+#####################################################################################
+#####################################################################################
+#####################################################################################
+# MEASURING
+#####################################################################################
+#####################################################################################
+#####################################################################################
+
+#####################################################################################
+# THIS FUNCTION RUNS A FUNCTION AND RETURNS (SECONDS, PEAK BYTES, RESULT)
+# IT IS TIMED --repeats TIMES AND THE FASTEST RUN COUNTS, THE SLOWER ONES ARE NOISE
+# THE TIMING RUNS AND THE MEMORY RUN ARE SEPARATE BECAUSE TRACEMALLOC SLOWS
+# EVERYTHING DOWN, PEAK BYTES IS NONE WHEN MEMORY IS NOT TRACKED
+# ANYTHING THE FUNCTION PRINTS IS THROWN AWAY
+#####################################################################################
+def measure(function, arguments):
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds = None
+        for _ in range(max(1, arguments.repeats)):
+            result = None
+            start = time.perf_counter()
+            result = function()
+            elapsed = time.perf_counter() - start
+            if seconds is None or elapsed < seconds:
+                seconds = elapsed
+
+        peak_bytes = None
+        if arguments.memory:
+            del result
+            tracemalloc.start()
+            result = function()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return seconds, peak_bytes, result
+
+
+#####################################################################################
+# THIS FUNCTION PRINTS AND STORES ONE RESULT
+#####################################################################################
+def record(results, name, seconds, peak_bytes, items=None):
+    results[name] = {"seconds": seconds, "peak_mb": None if peak_bytes is None else peak_bytes / 1048576}
+    line = "  [*] %-44s %9.4f s" % (name, seconds)
+    if items:
+        line += "  %12s rows/s" % format(int(items / seconds) if seconds > 0 else 0, ",")
+    if peak_bytes is not None:
+        line += "  peak %8.1f MB" % (peak_bytes / 1048576)
+    print(line)
+
+
+#####################################################################################
+# THIS FUNCTION RUNS A WHOLE CYCLE THE WAY THE MONITOR DOES, STREAMING THE HISTORY
+# THROUGH THE MATCHER INTO A THROWAWAY LEDGER, AND RETURNS HOW MANY ROWS IT READ
+#####################################################################################
+def scan_fixture(main, watermarks, alert_list, batch_mode=False):
+    with tempfile.TemporaryDirectory() as state_dir:
+        alert_ledger = main.AlertLedger(os.path.join(state_dir, "bench.db"))
+        cancel_event = threading.Event()
+        history_stream = main.stream_browser_history(0, watermarks, None, None, cancel_event, batch_mode)
+        with contextlib.closing(history_stream):
+            _, row_count, _ = main.scan_history(history_stream, main.AlertMatcher(alert_list),
+                                                alert_ledger, cancel_event)
+        alert_ledger.connection.close()
+    return row_count
+
+
+#####################################################################################
+# THIS FUNCTION BENCHMARKS EVERY STAGE OF A CYCLE FOR ONE HISTORY SIZE
+#####################################################################################
+def bench_pipeline(main, size_name, row_count, arguments, results):
+    history_dir, end_epoch = build_history_fixture(row_count, arguments.seed)
+    install_browser_history_stub(history_dir)
+    source_key = "BenchChrome:Default"
+    print("\n  History: " + size_name + " rows")
+
+    # reading, a normal cycle only reads the last few minutes
+    # a first run (or a long outage) reads everything
+    incremental = lambda: main.get_browser_history(0, {source_key: {"last_visit": end_epoch - 600}})
+    seconds, peak, rows = measure(incremental, arguments)
+    record(results, "get_history[%s,last 10 minutes]" % size_name, seconds, peak, len(rows) or None)
+
+    # a whole cycle over everything, streamed, so its memory should not grow with the size
+    # with one site it stops at the first match, a site that never matches reads it all
+    # batch mode does the same over columns instead of one tuple per visit
+    for label, alert_list in (("first match", RETAILER_NAMES[:1]), ("no match", ["neverseenx"]),
+                              ("10 sites", make_alert_list(10))):
+        for mode, batch_mode in (("stream", False), ("batch", True)):
+            scan = lambda: scan_fixture(main, {source_key: {"last_visit": 0}}, alert_list, batch_mode)
+            seconds, peak, scanned = measure(scan, arguments)
+            record(results, "scan %s[%s,%s]" % (mode, size_name, label), seconds, peak, scanned)
+
+    everything = lambda: main.get_browser_history(0, {source_key: {"last_visit": 0}})
+    seconds, peak, history = measure(everything, arguments)
+    record(results, "get_history[%s,everything]" % size_name, seconds, peak, len(history))
+
+    # matching, against growing alert lists
+    for list_size in ALERT_LIST_SIZES:
+        alert_list = main.clean_history_list(make_alert_list(list_size))
+        label = "%s,%d sites" % (size_name, list_size)
+
+        text_matcher = main.build_alert_matcher(alert_list, "text")
+        seconds, peak, _ = measure(lambda: main.find_alerts(history, text_matcher), arguments)
+        record(results, "find_alerts text[%s]" % label, seconds, peak, len(history))
+
+        host_matcher = main.build_alert_matcher(alert_list, "host")
+        seconds, peak, _ = measure(lambda: main.find_alerts(history, host_matcher), arguments)
+        record(results, "find_alerts host[%s]" % label, seconds, peak, len(history))
+
+        # the old loop gets slow fast, it only runs where it finishes in reasonable time
+        if row_count * list_size <= arguments.legacy_limit:
+            seconds, peak, _ = measure(lambda: legacy_find_alerts(history, alert_list), arguments)
+            record(results, "legacy find_alerts[%s]" % label, seconds, peak, len(history))
+
+
+#####################################################################################
+# THIS FUNCTION BENCHMARKS THE ALERT SIDE, CLEANING THE LIST, WORDING IT AND SENDING
+#####################################################################################
+def bench_alerts(main, arguments, results):
+    print("\n  Alerts")
+    sent_emails = install_brevo_stub()
+    with contextlib.redirect_stdout(io.StringIO()):
+        notifier = main.BrevoNotifier("bench-key")
+    repeats = 1000
+
+    for list_size in ALERT_LIST_SIZES:
+        alert_list = make_alert_list(list_size)
+        seconds, peak, _ = measure(lambda: [main.clean_history_list(list(alert_list)) for _ in range(repeats)], arguments)
+        record(results, "clean_history_list[%d sites x%d]" % (list_size, repeats), seconds, peak)
+
+        seconds, peak, _ = measure(lambda: [main.make_list_readable(alert_list) for _ in range(repeats)], arguments)
+        record(results, "make_list_readable[%d sites x%d]" % (list_size, repeats), seconds, peak)
+
+    alert_list = make_alert_list(10)
+    payload = {"sites": alert_list, "shopper_name": "Bench", "user_name": "Bench", "user_email": "bench@example.com",
+               "visits": {site: [3, 1700000000.0, 1700003600.0] for site in alert_list}}
+    renderer = main.AlertRenderer("from@example.com")
+    send = lambda: [main.send_alert(notifier, renderer, payload) for _ in range(repeats)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds, peak, _ = measure(send, arguments)
+    record(results, "send_alert brevo stub[x%d]" % repeats, seconds, peak)
+
+    digest_renderer = main.AlertRenderer("from@example.com", 5)
+    seconds, peak, _ = measure(lambda: [digest_renderer.render(payload) for _ in range(repeats)], arguments)
+    record(results, "render digest[10 sites x%d]" % repeats, seconds, peak)
+    if not sent_emails:
+        print("  [!] The brevo stand-in never received an email")
+
+
+#####################################################################################
+# THIS FUNCTION COMPARES THE RESULTS WITH THE BASELINE
+# IT RETURNS A LIST OF EVERY BENCHMARK THAT GOT TOO MUCH SLOWER
+#####################################################################################
+def compare_with_baseline(results, baseline, tolerance):
+    failures = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        allowed = baseline[name]["seconds"] * (1 + tolerance)
+        if result["seconds"] > allowed and result["seconds"] - baseline[name]["seconds"] > BASELINE_FLOOR_SECONDS:
+            failures.append("%s took %.4f s, the baseline is %.4f s" % (name, result["seconds"], baseline[name]["seconds"]))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="shopsnitch benchmarks")
+    parser.add_argument("--sizes", default="10k",
+                        help="comma separated history sizes out of " + ", ".join(SIZES) + " (default 10k)")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the synthetic history")
+    parser.add_argument("--repeats", type=int, default=3, help="time everything this many times and keep the fastest")
+    parser.add_argument("--memory", action="store_true", help="also measure peak memory (runs everything twice)")
+    parser.add_argument("--legacy-limit", type=int, default=10 ** 7,
+                        help="only run the old find_alerts loop when rows x sites is at most this")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET_MS,
+                        help="milliseconds import main is allowed to take")
+    parser.add_argument("--runs", type=int, default=5, help="how many times to repeat the import measurement")
+    parser.add_argument("--tolerance", type=float, default=BASELINE_TOLERANCE,
+                        help="how much slower than the baseline is still fine (1.0 = twice as slow)")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    arguments = parser.parse_args()
+
+    size_names = [size.strip().lower() for size in arguments.sizes.split(",") if size.strip()]
+    for size_name in size_names:
+        if size_name not in SIZES:
+            parser.error("unknown size " + size_name)
+
+    print("\n  Startup")
+    failures = bench_startup(arguments.import_budget, arguments.runs)
+
+    # main is imported here, after the checks above measured a clean import
+    sys.path.insert(0, REPO_DIR)
+    import main as shopsnitch
+
+    results = {}
+    for size_name in size_names:
+        bench_pipeline(shopsnitch, size_name, SIZES[size_name], arguments, results)
+    bench_alerts(shopsnitch, arguments, results)
+
+    # compare with (or replace) the baseline
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+    if arguments.save_baseline:
+        baseline.update(results)
+        with open(BASELINE_FILE, "w") as baseline_file:
+            json.dump({"saved": datetime.now(timezone.utc).isoformat(), "python": sys.version.split()[0],
+                       "results": baseline}, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print("\n  [*] Saved the baseline to " + BASELINE_FILE)
+    else:
+        failures += compare_with_baseline(results, baseline, arguments.tolerance)
+
+    print("")
+    for failure in failures:
+        print("  [!] " + failure)
+    if failures:
+        sys.exit(1)
+    print("  [*] Everything is within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,62 @@
-# THESE IMPORTS ARE NECESSARY FOR THE BREVO API
+# THE BREVO SDK, BROWSER_HISTORY, DOTENV AND SMTPLIB ARE NOT IMPORTED HERE
+# THEY ARE BIG, SO EACH ONE IS IMPORTED INSIDE THE FUNCTION THAT NEEDS IT
+# THAT KEEPS STARTUP FAST AND LETS THIS FILE BE IMPORTED WITHOUT ALL OF THEM
 from __future__ import print_function
-import time
-import brevo_python
-from brevo_python.rest import ApiException
-from pprint import pprint
 
-# THIS IMPORTS ARE NECESSARY TO EXPLORE AND PARSE BROWSER HISTORY
-from browser_history import get_history
+# THIS IMPORTS ARE NECESSARY TO PARSE BROWSER HISTORY
 from datetime import datetime, timedelta, timezone
 
+# THESE IMPORTS ARE NECESSARY TO REMEMBER WHAT WAS ALREADY READ BETWEEN CYCLES
+# AND TO CATCH ERRORS FROM THE HISTORY DATABASES
+import json
+import sqlite3
+
+# THESE IMPORTS ARE NECESSARY TO READ THE HISTORY DATABASES DIRECTLY
+import shutil
+import tempfile
+from pathlib import Path
+
 # THIS IMPORT IS NECESSARY TO LOAD ENVIRONMENT VARIABLES
 import os
-from dotenv import load_dotenv
 
 # THESE ARE NECESSARY FOR THE SPLASH SCREEN TO WORK PROPERLY
 import getpass
 import platform
 
-# REGEX LIBRARY FOR DATA VALIDATION
+# REGEX LIBRARY FOR DATA VALIDATION AND FOR MATCHING ALERT SITES
 import re
 
+# THIS IMPORT IS NECESSARY TO FILL IN THE ALERT EMAIL TEMPLATES
+import string
+
+# THESE IMPORTS ARE NECESSARY TO MATCH ALERT SITES AGAINST THE HOST OF A URL
+import functools
+from urllib.parse import urlsplit
+
 # THIS IMPORT IS NECESSARY TO SLEEP THE PROGRAM
 import time
 
-# THIS IMPORT IS NECESSARY TO EXIT GRACEFULLY
+# THESE IMPORTS ARE NECESSARY TO WATCH THE HISTORY FILES FOR CHANGES
+import select
+import struct
+
+# THESE IMPORTS ARE NECESSARY TO SEND ALERTS IN THE BACKGROUND
+# AND TO STREAM HISTORY FROM THE WORKER THREADS
+import queue
+import random
+import threading
+
+# THIS IMPORT IS NECESSARY TO TIME EVERY STAGE OF A CYCLE
+import contextlib
+
+# THESE IMPORTS ARE NECESSARY TO HOLD HISTORY AS COLUMNS IN BATCH MODE
+import bisect
+import itertools
+import operator
+from array import array
+
+# THESE IMPORTS ARE NECESSARY TO EXIT GRACEFULLY
+import signal
 import sys
 
 
@@ -31,39 +64,250 @@ import sys
 #####################################################################################
 #####################################################################################
 #####################################################################################
-# LOAD ENVIRONMENT VARIABLES 
+# SETTINGS
 #####################################################################################
 #####################################################################################
 #####################################################################################
 
 #####################################################################################
-# THIS LOADS THE ENVIRONMENT VARIABLES FROM THE .env FILE SPECIFICALLY
+# THESE FUNCTIONS READ NUMBERS AND ON/OFF SWITCHES FROM THE ENVIRONMENT
+# A MISSING VALUE QUIETLY USES THE DEFAULT, A BROKEN ONE SAYS SO FIRST
 #####################################################################################
-
-load_dotenv()
+def get_number_setting(name, default, cast=int):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        print("  [!] " + name + " must be a number")
+        print("  [!] Defaulting to " + str(default))
+        return default
+
+def get_flag_setting(name, default=False):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
 
 #####################################################################################
-# ASSIGN ENVIRONMENT VARIABLES TO PYTHON VARIABLES
+# THESE ARE THE SETTINGS, THE VALUES HERE ARE ONLY DEFAULTS
+# load_configuration() FILLS THEM IN FROM THE .env FILE AND THE ENVIRONMENT
 #####################################################################################
 
 
 # THESE VARIABLES ARE USED TO CONFIGURE THE BREVO API
-API_KEY = os.getenv("API_KEY")
-PORT = os.getenv("PORT")
+API_KEY = None
+PORT = None
+FROM_EMAIL = None
+
+
+# THESE LET THE PROGRAM START WITHOUT ASKING ANY QUESTIONS
+# IF ALL FOUR ARE SET (IN THE ENVIRONMENT, THE .env FILE, A --config FILE OR ON THE
+# COMMAND LINE) THE PROMPTS ARE SKIPPED. ALERT_SITES IS SEPARATED BY SPACES OR COMMAS
+USER_NAME = None
+USER_EMAIL = None
+SHOPPER_NAME = None
+ALERT_SITES = None
+# SETTING THIS ACCEPTS THE CONSENT NOTICE ON THE SPLASH SCREEN WITHOUT PRESSING ENTER
+# EITHER WAY THE ANSWER IS RECORDED IN STATE_DIR AND NOT ASKED FOR AGAIN
+CONSENT_ACKNOWLEDGED = False
 
 
 # THIS CONSTANT WILL DEFINE THE REFRESH RATE IN MINUTES
 # LOWERING THIS VALUE MAY CAUSE THE PROGRAM TO RUN SLOWER
 # RAISING THIS VALUE MAY CAUSE THE PROGRAM TO GIVE LATENT RESULTS
 # MUST BE CAST AS AN INTEGER, BE CAUTIOUS WHEN CHANGING THIS VALUE
-TIME_INTERVAL = os.getenv("TIME_INTERVAL")
-FROM_EMAIL = os.getenv("FROM_EMAIL")
-try:
-    TIME_INTERVAL = int(TIME_INTERVAL)
-except ValueError:
-    print("  [!] TIME_INTERVAL must be an integer")
-    print("  [!] Defaulting to 1 minute")
-    TIME_INTERVAL = 1
+TIME_INTERVAL = 1
+
+# THE BROWSER PROFILES ARE READ AT THE SAME TIME ON UP TO HISTORY_WORKERS THREADS
+# A PROFILE THAT PRODUCES NOTHING FOR SOURCE_TIMEOUT SECONDS IS SKIPPED FOR THAT CYCLE
+# HISTORY IS READ AND MATCHED HISTORY_BATCH_SIZE VISITS AT A TIME, SO A LONG HISTORY
+# NEVER HAS TO FIT IN MEMORY
+HISTORY_WORKERS = 8
+SOURCE_TIMEOUT = 30
+HISTORY_BATCH_SIZE = 1000
+# BATCH MODE KEEPS EVERY BATCH AS A FEW COLUMNS (ONE ARRAY OF TIMES, ONE STRING OF
+# URLS AND ONE OF TITLES) INSTEAD OF A TUPLE AND A DATETIME PER VISIT, AND MATCHES
+# A WHOLE BATCH AT ONCE. IT IS FASTER AND SMALLER ON LONG HISTORIES
+BATCH_MODE = False
+
+# THIS PICKS HOW ALERTS ARE DELIVERED
+# "brevo" SENDS THEM THROUGH THE BREVO API (THE DEFAULT)
+# "smtp" SENDS THEM THROUGH ANY SMTP SERVER, KEEPING ONE CONNECTION OPEN
+#        THE DEFAULTS POINT AT THE MAILCATCHER FROM THE DEV SHELL
+# "file" WRITES THEM TO ALERT_FILE ("-" MEANS THE TERMINAL), HANDY FOR TESTING
+NOTIFIER = "brevo"
+SMTP_HOST = "localhost"
+SMTP_PORT = 1025
+SMTP_USERNAME = None
+SMTP_PASSWORD = None
+SMTP_STARTTLS = False
+ALERT_FILE = "-"
+
+# THIS DIRECTORY HOLDS EVERYTHING THAT HAS TO SURVIVE A RESTART
+# THE LAST VISIT SEEN FOR EVERY BROWSER PROFILE, THE ALERT LEDGER AND THE OUTBOX
+STATE_DIR = os.path.join(os.path.expanduser("~"), ".shopsnitch")
+WATERMARK_FILE = os.path.join(STATE_DIR, "watermarks.json")
+STATE_DATABASE = os.path.join(STATE_DIR, "shopsnitch.db")
+CONSENT_FILE = os.path.join(STATE_DIR, "consent")
+# THE MONITOR AND THE DELIVERY THREAD SHARE THE STATE DATABASE, ONE WAITS UP TO THIS
+# MANY SECONDS FOR THE OTHER TO FINISH WRITING
+STATE_BUSY_TIMEOUT = 30
+
+# EVERY VISIT ONLY EVER CAUSES ONE ALERT, ON TOP OF THAT A SITE IS NOT ALERTED
+# ABOUT AGAIN UNTIL SUPPRESSION_WINDOW MINUTES HAVE PASSED SINCE ITS LAST ALERT
+# SITE_SUPPRESSION_WINDOWS OVERRIDES IT PER SITE, FOR EXAMPLE "amazon=60,ebay=5"
+SUPPRESSION_WINDOW = 0
+SITE_SUPPRESSION_WINDOWS = ""
+# HOW MANY DAYS OF ALERTED VISITS TO REMEMBER
+LEDGER_RETENTION_DAYS = 7
+
+# ONE MONITOR CAN ALERT SEVERAL PEOPLE ABOUT SEVERAL SHOPPERS, THE HISTORY IS STILL
+# ONLY READ AND MATCHED ONCE PER CYCLE. PROFILES_FILE IS A JSON LIST OF PROFILES
+# [{"name": "mom", "user_name": "Mom", "user_email": "mom@example.com",
+#   "shopper_name": "Al", "alert_sites": "amazon ebay",
+#   "suppression_window": 30, "site_suppression_windows": "amazon=60"}]
+# THE TWO SUPPRESSION SETTINGS ARE OPTIONAL AND DEFAULT TO THE ONES ABOVE
+# WITHOUT A PROFILES FILE THERE IS ONE PROFILE, BUILT FROM USER_NAME, USER_EMAIL,
+# SHOPPER_NAME AND ALERT_SITES (OR THE PROMPTS)
+PROFILES_FILE = None
+DEFAULT_PROFILE = "default"
+
+# ALERTS ARE SENT FROM A BACKGROUND THREAD THROUGH AN OUTBOX THAT SURVIVES A RESTART
+# MATCHES FOR THE SAME RECIPIENT WITHIN COALESCE_SECONDS ARE MERGED INTO ONE EMAIL
+# A FAILED SEND IS RETRIED WITH EXPONENTIAL BACKOFF (RETRY_BASE_SECONDS DOUBLING
+# UP TO RETRY_MAX_SECONDS, WITH JITTER) UNTIL MAX_SEND_ATTEMPTS HAVE BEEN MADE
+COALESCE_SECONDS = 10
+MAX_SEND_ATTEMPTS = 8
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 900
+# A CYCLE THAT FAILS (A BROKEN HISTORY DATABASE, A FULL DISK, A BUG) IS TRIED AGAIN
+# UP TO CYCLE_RETRIES TIMES, WAITING CYCLE_RETRY_SECONDS (DOUBLING, WITH JITTER) IN
+# BETWEEN. AFTER THAT IT IS SKIPPED AND THE NEXT CYCLE STARTS WHERE IT LEFT OFF
+CYCLE_RETRIES = 3
+CYCLE_RETRY_SECONDS = 5
+# WHEN THIS IS MORE THAN 0 ALERTS ARE HELD AND SENT AS ONE DIGEST EVERY DIGEST_CYCLES
+# CYCLES, SAYING HOW MANY TIMES EACH SITE WAS VISITED AND WHEN IT WAS FIRST AND LAST SEEN
+DIGEST_CYCLES = 0
+
+# THIS DECIDES HOW ALERT SITES ARE MATCHED
+# "text" LOOKS FOR THE SITE ANYWHERE IN THE PAGE TITLE (THE ORIGINAL BEHAVIOUR)
+# "host" ONLY LOOKS AT THE HOST OF THE URL, SO "amazon" MATCHES www.amazon.co.uk
+# BUT NOT A SEARCH FOR "amazon" ON SOME OTHER SITE
+MATCH_MODE = "text"
+# HOW MANY PARSED URLS AND HOSTS TO KEEP AROUND IN HOST MODE
+HOST_CACHE_SIZE = 4096
+
+# WHEN THIS IS ON THE PROGRAM WATCHES THE HISTORY FILES INSTEAD OF SLEEPING
+# TIME_INTERVAL MINUTES, A CYCLE RUNS AS SOON AS A BROWSER WRITES A VISIT
+# DEBOUNCE_SECONDS IS HOW LONG THE FILES HAVE TO BE QUIET BEFORE THE CYCLE STARTS
+# MAX_QUIET_INTERVAL (MINUTES) RUNS A CYCLE ANYWAY IF NOTHING HAS CHANGED IN A WHILE
+WATCH_HISTORY = False
+DEBOUNCE_SECONDS = 2
+MAX_QUIET_INTERVAL = 60
+# HOW OFTEN TO CHECK THE FILES WHEN INOTIFY IS NOT AVAILABLE
+STAT_POLL_SECONDS = 2
+
+# WHEN THIS IS ON (AND WATCH_HISTORY IS OFF) THE TIME BETWEEN CYCLES FOLLOWS THE
+# BROWSING INSTEAD OF STAYING AT TIME_INTERVAL. IT STARTS AT TIME_INTERVAL, DROPS TO
+# MIN_INTERVAL_SECONDS AS SOON AS A CYCLE FINDS A MATCH, IS DIVIDED BY
+# SCHEDULE_BACKOFF WHEN THERE WAS NEW HISTORY AND MULTIPLIED BY IT WHEN THERE WAS
+# NOTHING, NEVER GOING PAST MAX_INTERVAL_SECONDS
+# EVERY WAIT IS MOVED BY UP TO SCHEDULE_JITTER (0.1 = 10%) EITHER WAY
+ADAPTIVE_SCHEDULE = False
+MIN_INTERVAL_SECONDS = 15
+MAX_INTERVAL_SECONDS = 1800
+SCHEDULE_BACKOFF = 2
+SCHEDULE_JITTER = 0.1
+
+# EVERY CYCLE IS TIMED STAGE BY STAGE AND COUNTED (ROWS, MATCHES, ALERTS, FAILURES)
+# METRICS_LOG PRINTS ONE LINE OF JSON WITH THOSE NUMBERS AFTER EVERY CYCLE
+# METRICS_PORT SERVES THEM IN PROMETHEUS TEXT FORMAT ON http://127.0.0.1:PORT/metrics
+# (0 TURNS THE ENDPOINT OFF)
+METRICS_LOG = False
+METRICS_PORT = 0
+# THE UPPER BOUNDS OF THE CYCLE LATENCY HISTOGRAM, IN SECONDS
+CYCLE_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+#####################################################################################
+# THIS FUNCTION LOADS THE .env FILE AND ASSIGNS THE ENVIRONMENT VARIABLES
+# TO THE SETTINGS ABOVE, IT IS CALLED ONCE WHEN THE PROGRAM STARTS
+# A CONFIG FILE USES THE SAME FORMAT AS .env AND IS READ INSTEAD OF IT
+# VALUES ALREADY IN THE ENVIRONMENT WIN OVER VALUES FROM THE FILE
+#####################################################################################
+def load_configuration(config_file=None):
+    global API_KEY, PORT, FROM_EMAIL, TIME_INTERVAL, HISTORY_WORKERS, SOURCE_TIMEOUT, HISTORY_BATCH_SIZE, BATCH_MODE
+    global USER_NAME, USER_EMAIL, SHOPPER_NAME, ALERT_SITES, CONSENT_ACKNOWLEDGED
+    global NOTIFIER, SMTP_HOST, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD, SMTP_STARTTLS, ALERT_FILE
+    global STATE_DIR, WATERMARK_FILE, STATE_DATABASE, CONSENT_FILE, SUPPRESSION_WINDOW, SITE_SUPPRESSION_WINDOWS
+    global PROFILES_FILE
+    global COALESCE_SECONDS, MAX_SEND_ATTEMPTS, RETRY_BASE_SECONDS, RETRY_MAX_SECONDS, DIGEST_CYCLES
+    global CYCLE_RETRIES, CYCLE_RETRY_SECONDS
+    global MATCH_MODE, WATCH_HISTORY, DEBOUNCE_SECONDS, MAX_QUIET_INTERVAL
+    global ADAPTIVE_SCHEDULE, MIN_INTERVAL_SECONDS, MAX_INTERVAL_SECONDS, SCHEDULE_BACKOFF, SCHEDULE_JITTER
+    global METRICS_LOG, METRICS_PORT
+
+    # this loads the environment variables from the .env file specifically
+    # (or from the config file if one was given)
+    from dotenv import load_dotenv
+    if config_file is not None and not os.path.isfile(config_file):
+        print("  [!] Config file " + config_file + " does not exist")
+        sys.exit(2)
+    load_dotenv(config_file)
+
+    API_KEY = os.getenv("API_KEY")
+    PORT = os.getenv("PORT")
+    FROM_EMAIL = os.getenv("FROM_EMAIL")
+    TIME_INTERVAL = get_number_setting("TIME_INTERVAL", 1)
+    HISTORY_WORKERS = get_number_setting("HISTORY_WORKERS", 8)
+    SOURCE_TIMEOUT = get_number_setting("SOURCE_TIMEOUT", 30, float)
+    HISTORY_BATCH_SIZE = get_number_setting("HISTORY_BATCH_SIZE", 1000)
+    BATCH_MODE = get_flag_setting("BATCH_MODE")
+
+    USER_NAME = os.getenv("USER_NAME")
+    USER_EMAIL = os.getenv("USER_EMAIL")
+    SHOPPER_NAME = os.getenv("SHOPPER_NAME")
+    ALERT_SITES = os.getenv("ALERT_SITES")
+    CONSENT_ACKNOWLEDGED = get_flag_setting("CONSENT_ACKNOWLEDGED")
+
+    NOTIFIER = (os.getenv("NOTIFIER") or "brevo").lower()
+    SMTP_HOST = os.getenv("SMTP_HOST") or "localhost"
+    SMTP_PORT = get_number_setting("SMTP_PORT", 1025)
+    SMTP_USERNAME = os.getenv("SMTP_USERNAME")
+    SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+    SMTP_STARTTLS = get_flag_setting("SMTP_STARTTLS")
+    ALERT_FILE = os.getenv("ALERT_FILE") or "-"
+
+    STATE_DIR = os.getenv("STATE_DIR") or STATE_DIR
+    WATERMARK_FILE = os.path.join(STATE_DIR, "watermarks.json")
+    STATE_DATABASE = os.path.join(STATE_DIR, "shopsnitch.db")
+    CONSENT_FILE = os.path.join(STATE_DIR, "consent")
+    SUPPRESSION_WINDOW = get_number_setting("SUPPRESSION_WINDOW", 0)
+    SITE_SUPPRESSION_WINDOWS = os.getenv("SITE_SUPPRESSION_WINDOWS") or ""
+    PROFILES_FILE = os.getenv("PROFILES_FILE") or None
+
+    COALESCE_SECONDS = get_number_setting("COALESCE_SECONDS", 10, float)
+    MAX_SEND_ATTEMPTS = get_number_setting("MAX_SEND_ATTEMPTS", 8)
+    RETRY_BASE_SECONDS = get_number_setting("RETRY_BASE_SECONDS", 5, float)
+    RETRY_MAX_SECONDS = get_number_setting("RETRY_MAX_SECONDS", 900, float)
+    CYCLE_RETRIES = get_number_setting("CYCLE_RETRIES", 3)
+    CYCLE_RETRY_SECONDS = get_number_setting("CYCLE_RETRY_SECONDS", 5, float)
+    DIGEST_CYCLES = get_number_setting("DIGEST_CYCLES", 0)
+
+    MATCH_MODE = (os.getenv("MATCH_MODE") or "text").lower()
+    WATCH_HISTORY = get_flag_setting("WATCH_HISTORY")
+    DEBOUNCE_SECONDS = get_number_setting("DEBOUNCE_SECONDS", 2, float)
+    MAX_QUIET_INTERVAL = get_number_setting("MAX_QUIET_INTERVAL", 60)
+
+    ADAPTIVE_SCHEDULE = get_flag_setting("ADAPTIVE_SCHEDULE")
+    MIN_INTERVAL_SECONDS = get_number_setting("MIN_INTERVAL_SECONDS", 15, float)
+    MAX_INTERVAL_SECONDS = get_number_setting("MAX_INTERVAL_SECONDS", 1800, float)
+    SCHEDULE_BACKOFF = get_number_setting("SCHEDULE_BACKOFF", 2, float)
+    SCHEDULE_JITTER = get_number_setting("SCHEDULE_JITTER", 0.1, float)
+
+    METRICS_LOG = get_flag_setting("METRICS_LOG")
+    METRICS_PORT = get_number_setting("METRICS_PORT", 0)
 
 # THESE ARE REGEX PATTERNS FOR DATA VALIDATION
 NAME_REGEX = r"^[A-Za-z\- ]+$"
@@ -126,6 +370,9 @@ def display_splashscreen():
 # THIS FUNCTION CONFIGURES THE BREVO API AND RETURNS THE API INSTANCE 
 #####################################################################################
 def configure_brevo_api(api_key):
+    # the brevo sdk is only loaded when brevo is actually used
+    import brevo_python
+
     # configure api key authorization: 
     configuration = brevo_python.Configuration()
     configuration.api_key['api-key'] = api_key
@@ -146,116 +393,1563 @@ def configure_brevo_api(api_key):
 def make_list_readable(site_list):
     # make the site_list a reasonable string
     # this will make it so that lists of 2 or more items are formatted correctly with an "and"
-    # so you either get "A" "A and B" or "A, B, ... and Z" 
-    return_string = ""
-    for i in range(0, len(site_list)):
-        if i == len(site_list) - 1 and len(site_list) > 1:
-            return_string += "and " + site_list[i].upper()
-        elif len(site_list) <= 2:
-            return_string += site_list[i].upper() + " "
+    # so you either get "A" "A and B" or "A, B, ... and Z"
+    site_names = [site.upper() for site in site_list]
+    if len(site_names) <= 2:
+        return " and ".join(site_names)
+    return ", ".join(site_names[:-1]) + ", and " + site_names[-1]
+
+#####################################################################################
+# THESE ARE THE ALERT EMAILS, THEY ARE ONLY FILLED IN WHEN AN ALERT IS SENT
+#####################################################################################
+ALERT_SUBJECT = string.Template("ALERT! $sites found in browser history!")
+ALERT_BODY = string.Template("""
+        <h1>ALERT!</h1>
+        <h2>$sites found in browser history!</h2>
+        <h3>You may want to give $shopper_name a call before they purchase!<h3>
+        """)
+DIGEST_SUBJECT = string.Template("DIGEST! $sites found in browser history!")
+DIGEST_BODY = string.Template("""
+        <h1>DIGEST!</h1>
+        <h2>$sites found in browser history over the last $cycles checks!</h2>
+        <table>
+            <tr><th>Site</th><th>Visits</th><th>First seen</th><th>Last seen</th></tr>$rows
+        </table>
+        <h3>You may want to give $shopper_name a call before they purchase!<h3>
+        """)
+DIGEST_ROW = string.Template("""
+            <tr><td>$site</td><td>$count</td><td>$first_seen</td><td>$last_seen</td></tr>""")
+
+#####################################################################################
+# THIS CLASS TURNS A QUEUED ALERT INTO THE EMAIL DICTIONARY EVERY NOTIFIER KNOWS HOW
+# TO SEND. THE SENDER AND REPLY TO ONLY CHANGE WITH THE CONFIGURATION, SO THEY ARE
+# BUILT ONCE HERE INSTEAD OF FOR EVERY ALERT
+# WITH DIGEST_CYCLES SET IT WRITES A DIGEST WITH THE VISIT COUNTS AND TIMES INSTEAD
+#####################################################################################
+class AlertRenderer:
+    def __init__(self, from_email, digest_cycles=0):
+        self.sender = {"name": "your friendly neighborhood shopsnitch", "email": from_email}
+        self.reply_to = {"name": "your friendly neighborhood shopsnitch", "email": from_email}
+        self.digest_cycles = digest_cycles
+
+    # THIS FUNCTION BUILDS THE EMAIL FOR A QUEUED ALERT
+    def render(self, payload):
+        site_list_string = make_list_readable(payload["sites"])
+        if self.digest_cycles:
+            subject = DIGEST_SUBJECT.substitute(sites=site_list_string)
+            html_content = DIGEST_BODY.substitute(sites=site_list_string, cycles=self.digest_cycles,
+                                                  shopper_name=payload["shopper_name"],
+                                                  rows=self.render_digest_rows(payload))
         else:
-            return_string += site_list[i].upper() + ", "
-            
-    # return the string
-    return return_string
+            subject = ALERT_SUBJECT.substitute(sites=site_list_string)
+            html_content = ALERT_BODY.substitute(sites=site_list_string, shopper_name=payload["shopper_name"])
+        return {"subject": subject, "sender": self.sender, "reply_to": self.reply_to,
+                "to": [{"email": payload["user_email"], "name": payload["user_name"]}],
+                "html_content": html_content}
+
+    # THIS FUNCTION WRITES ONE ROW OF THE DIGEST TABLE FOR EVERY SITE
+    # ALERTS QUEUED BY AN OLDER VERSION HAVE NO VISIT COUNTS, THOSE ROWS STAY EMPTY
+    def render_digest_rows(self, payload):
+        site_visits = payload.get("visits", {})
+        rows = []
+        for site in payload["sites"]:
+            if site in site_visits:
+                count, first_seen, last_seen = site_visits[site]
+                rows.append(DIGEST_ROW.substitute(site=site.upper(), count=count,
+                                                  first_seen=format_visit_time(first_seen),
+                                                  last_seen=format_visit_time(last_seen)))
+            else:
+                rows.append(DIGEST_ROW.substitute(site=site.upper(), count="", first_seen="", last_seen=""))
+        return "".join(rows)
 
 #####################################################################################
-# THIS FUNCTION SENDS AN ALERT USING THE BREVO API
+# THIS FUNCTION FORMATS A VISIT TIME (SECONDS SINCE 1970) IN LOCAL TIME FOR AN EMAIL
 #####################################################################################
-def send_alert(api_instance, site_list, shopper_name, user_name, user_email, from_email):
+def format_visit_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+
+#####################################################################################
+# THIS FUNCTION SENDS AN ALERT USING WHICHEVER NOTIFIER WAS CONFIGURED
+# IT RETURNS TRUE IF THE ALERT WENT OUT
+#####################################################################################
+def send_alert(notifier, alert_renderer, payload):
 
     # notify the terminal monitoring that an alert is being sent
-    print("  [*] Sending alert to " + user_name + " at " + user_email)
+    print("  [*] Sending alert to " + payload["user_name"] + " at " + payload["user_email"])
 
-    #####################################################################################
-    # create the components of the email
-    #####################################################################################
-    site_list_string = make_list_readable(site_list)
-    subject = "ALERT! " + site_list_string + " found in browser history!"
-    
-    sender = {"name": "your friendly neighborhood shopsnitch", "email":from_email}
-    reply_to = {"name": "your friendly neighborhood shopsnitch", "email":from_email}
-    to = [{"email":user_email,"name":user_name}]
+    # create the email and hand it over
+    return notifier.send(alert_renderer.render(payload))
 
-    # format the body of the email with html
-    html_content = """
-        <h1>ALERT!</h1>
-        <h2>""" + site_list_string + """ found in browser history!</h2>
-        <h3>You may want to give """ + shopper_name + """ a call before they purchase!<h3>
-        """
-
-    #####################################################################################
-    # combine the variables into an email object as defined by the brevo api
-    #####################################################################################
-    send_smtp_email = brevo_python.SendSmtpEmail(to=to, reply_to=reply_to,
-                                             html_content=html_content, sender=sender, subject=subject) # SendSmtpEmail | Values to send a transactional email
-    # try to send an email
+#####################################################################################
+#####################################################################################
+#####################################################################################
+# NOTIFIERS
+# EVERY NOTIFIER HAS A send(email) FUNCTION THAT TAKES THE DICTIONARY FROM
+# AlertRenderer.render AND RETURNS TRUE IF IT WAS DELIVERED, AND A close() FUNCTION
+#####################################################################################
+#####################################################################################
+#####################################################################################
+
+#####################################################################################
+# THIS NOTIFIER SENDS ALERTS THROUGH THE BREVO API
+#####################################################################################
+class BrevoNotifier:
+    def __init__(self, api_key):
+        self.api_instance = configure_brevo_api(api_key)
+
+    def send(self, email):
+        # already loaded by configure_brevo_api, so this is only a lookup
+        import brevo_python
+        from brevo_python.rest import ApiException
+
+        #####################################################################################
+        # combine the variables into an email object as defined by the brevo api
+        #####################################################################################
+        send_smtp_email = brevo_python.SendSmtpEmail(to=email["to"], reply_to=email["reply_to"],
+                                                 html_content=email["html_content"], sender=email["sender"],
+                                                 subject=email["subject"]) # SendSmtpEmail | Values to send a transactional email
+        # try to send an email
+        try:
+            api_response = self.api_instance.send_transac_email(send_smtp_email)
+            # pprint(api_response)
+        # if there is an error, print the error
+        except ApiException as e:
+            print("  [!] Exception when calling TransactionalEmailsApi->send_transac_email: %s\n" % e)
+            return False
+        return True
+
+    def close(self):
+        pass
+
+#####################################################################################
+# THIS NOTIFIER SENDS ALERTS TO AN SMTP SERVER
+# IT LOGS IN ONCE AND KEEPS THE CONNECTION OPEN FOR THE NEXT ALERT, IF THE SERVER
+# HAS HUNG UP IN THE MEANTIME IT RECONNECTS AND TRIES ONCE MORE
+#####################################################################################
+class SmtpNotifier:
+    def __init__(self, host, port, username=None, password=None, starttls=False):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.connection = None
+
+    # THIS FUNCTION OPENS AND AUTHENTICATES THE CONNECTION
+    def connect(self):
+        import smtplib
+        connection = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.starttls:
+            connection.starttls()
+        if self.username:
+            connection.login(self.username, self.password or "")
+        self.connection = connection
+
+    # THIS FUNCTION TURNS THE ALERT INTO A MIME MESSAGE
+    def build_message(self, email):
+        from email.message import EmailMessage
+        from email.utils import formataddr
+        message = EmailMessage()
+        message["Subject"] = email["subject"]
+        message["From"] = formataddr((email["sender"]["name"], email["sender"]["email"]))
+        message["Reply-To"] = formataddr((email["reply_to"]["name"], email["reply_to"]["email"]))
+        message["To"] = ", ".join(formataddr((to["name"], to["email"])) for to in email["to"])
+        message.set_content(email["subject"])
+        message.add_alternative(email["html_content"], subtype="html")
+        return message
+
+    def send(self, email):
+        import smtplib
+        message = self.build_message(email)
+        for attempt in range(2):
+            try:
+                if self.connection is None:
+                    self.connect()
+                self.connection.send_message(message)
+                return True
+            # the server closed the connection while we were idle, so open a new one
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self.connection = None
+                if attempt == 1:
+                    print("  [!] Could not reach the SMTP server: %s" % e)
+            except (smtplib.SMTPException, OSError) as e:
+                print("  [!] Exception when sending the alert over SMTP: %s" % e)
+                self.close()
+                return False
+        return False
+
+    def close(self):
+        import smtplib
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
+
+#####################################################################################
+# THIS NOTIFIER WRITES EVERY ALERT AS A LINE OF JSON TO A FILE OR THE TERMINAL
+#####################################################################################
+class FileNotifier:
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, email):
+        line = json.dumps(email, sort_keys=True)
+        if self.path == "-":
+            print(line)
+        else:
+            with open(self.path, "a") as alert_file:
+                alert_file.write(line + "\n")
+        return True
+
+    def close(self):
+        pass
+
+#####################################################################################
+# THIS FUNCTION CREATES THE NOTIFIER THAT WAS PICKED IN THE ENVIRONMENT
+#####################################################################################
+def configure_notifier(notifier_name):
+    if notifier_name == "smtp":
+        print("  [*] Sending alerts through SMTP at " + SMTP_HOST + ":" + str(SMTP_PORT))
+        return SmtpNotifier(SMTP_HOST, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD, SMTP_STARTTLS)
+    if notifier_name == "file":
+        print("  [*] Writing alerts to " + ("the terminal" if ALERT_FILE == "-" else ALERT_FILE))
+        return FileNotifier(ALERT_FILE)
+    if notifier_name != "brevo":
+        print("  [!] NOTIFIER must be brevo, smtp or file")
+        print("  [!] Defaulting to brevo")
+    return BrevoNotifier(API_KEY)
+
+
+
+
+#####################################################################################
+# THIS FUNCTION LOADS THE PER-BROWSER WATERMARKS FROM DISK
+# A WATERMARK IS THE NEWEST VISIT WE HAVE ALREADY LOOKED AT FOR ONE PROFILE
+#####################################################################################
+def load_watermarks(path):
+    # if there is no watermark file yet then every browser starts fresh
     try:
-        api_response = api_instance.send_transac_email(send_smtp_email)
-        # pprint(api_response)
-    # if there is an error, print the error
-    except ApiException as e:
-        print("  [!] Exception when calling TransactionalEmailsApi->send_transac_email: %s\n" % e)
+        with open(path, "r") as watermark_file:
+            return json.load(watermark_file)
+    except FileNotFoundError:
+        return {}
+    # a broken file should not stop the monitor, it just means a fresh start
+    except (ValueError, OSError) as e:
+        print("  [!] Could not read watermarks, starting fresh: %s" % e)
+        return {}
 
+#####################################################################################
+# THIS FUNCTION SAVES THE PER-BROWSER WATERMARKS TO DISK
+#####################################################################################
+def save_watermarks(path, watermarks):
+    # make sure the state directory exists
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first and swap it in so a crash
+    # halfway through never leaves a half written file behind
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as watermark_file:
+        json.dump(watermarks, watermark_file, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
 
+#####################################################################################
+# THIS FUNCTION FINDS EVERY HISTORY DATABASE ON THE MACHINE
+# IT RETURNS A LIST OF (SOURCE KEY, BROWSER, HISTORY PATH) WHERE THE SOURCE KEY
+# IS "BROWSER:PROFILE" SO EVERY PROFILE GETS ITS OWN WATERMARK
+#####################################################################################
+def get_history_sources():
+    from browser_history.utils import get_browsers
+    sources = []
+    for browser_class in get_browsers():
+        # browsers that are not supported on this platform refuse to be created
+        try:
+            browser = browser_class()
+        except AssertionError:
+            continue
+        # one history database per profile
+        for profile_dir in browser.profiles(profile_file=browser.history_file):
+            history_path = browser.history_path_profile(profile_dir)
+            sources.append((browser.name + ":" + profile_dir, browser, history_path))
+    return sources
 
+#####################################################################################
+# THIS FUNCTION RETURNS THE SIZE AND MODIFICATION TIME OF A HISTORY DATABASE
+# AND ITS WRITE AHEAD LOG, IF THIS DOES NOT CHANGE THEN THERE ARE NO NEW VISITS
+#####################################################################################
+def get_file_signature(history_path):
+    signature = []
+    for path in (str(history_path), str(history_path) + "-wal"):
+        try:
+            stat_result = os.stat(path)
+            signature.append([stat_result.st_mtime_ns, stat_result.st_size])
+        except FileNotFoundError:
+            signature.append(None)
+    return signature
 
 #####################################################################################
-# THIS FUNCTION CHECKS THE BROWSER HISTORY FOR THE SPECIFIED TIME PERIOD
-# THE TIME PERIOD PARAMETER IS IN MINUTES
+# THESE QUERIES READ NEW VISITS STRAIGHT OUT OF THE HISTORY DATABASES
+# THEY ARE KEYED BY THE NAME OF THE HISTORY FILE SO EVERY CHROMIUM AND FIREFOX
+# BASED BROWSER SHARES ONE QUERY, THE NUMBER IS THE DIFFERENCE IN SECONDS BETWEEN
+# THE BROWSER'S CLOCK AND THE UNIX EPOCH (CHROMIUM COUNTS FROM 1601)
+# BOTH FILTER ON THE INDEXED VISIT TIME SO ONLY NEW ROWS ARE EVER TOUCHED
 #####################################################################################
-def get_browser_history(time_period):
-    
-    returnlist = []
-    print("Checking installed browsers")
+CHROMIUM_HISTORY_SQL = """
+    SELECT visits.visit_time, urls.url, urls.title
+    FROM visits INNER JOIN urls ON visits.url = urls.id
+    WHERE visits.visit_time > ?
+    ORDER BY visits.visit_time
+"""
+FIREFOX_HISTORY_SQL = """
+    SELECT moz_historyvisits.visit_date, moz_places.url, moz_places.title
+    FROM moz_historyvisits INNER JOIN moz_places ON moz_historyvisits.place_id = moz_places.id
+    WHERE moz_historyvisits.visit_date > ? AND moz_places.url LIKE 'http%' AND moz_places.title IS NOT NULL
+    ORDER BY moz_historyvisits.visit_date
+"""
+NATIVE_HISTORY_QUERIES = {
+    "History": (CHROMIUM_HISTORY_SQL, 11644473600),
+    "places.sqlite": (FIREFOX_HISTORY_SQL, 0),
+}
 
-    # get the available browser history
-    output = get_history()
+#####################################################################################
+# THIS FUNCTION RUNS A HISTORY QUERY AGAINST A READ ONLY CONNECTION
+# IT YIELDS THE ROWS IN BATCHES SO A BIG HISTORY IS NEVER IN MEMORY ALL AT ONCE
+#####################################################################################
+def query_history_database(database_uri, query, since, batch_size):
+    # a browser that is running keeps its history locked, do not wait for it
+    # a locked database goes straight to the snapshot instead
+    connection = sqlite3.connect(database_uri, uri=True, timeout=0)
+    try:
+        cursor = connection.execute(query, (since,))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        connection.close()
+
+#####################################################################################
+# THIS FUNCTION RUNS A HISTORY QUERY AGAINST A PRIVATE COPY OF THE DATABASE
+# THIS IS ONLY NEEDED WHEN THE BROWSER HOLDS A LOCK ON THE REAL FILE
+# THE WRITE AHEAD LOG IS COPIED TOO, OTHERWISE THE NEWEST VISITS WOULD BE MISSING
+#####################################################################################
+def query_history_snapshot(history_path, query, since, batch_size):
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        snapshot_path = Path(snapshot_dir) / Path(history_path).name
+        shutil.copyfile(history_path, snapshot_path)
+        wal_path = str(history_path) + "-wal"
+        if os.path.exists(wal_path) and os.path.getsize(wal_path) > 0:
+            # sqlite replays the log into the copy when it is opened
+            shutil.copyfile(wal_path, str(snapshot_path) + "-wal")
+            yield from query_history_database(snapshot_path.as_uri(), query, since, batch_size)
+        else:
+            # nothing else can touch the copy so there is no need to lock it
+            yield from query_history_database(snapshot_path.as_uri() + "?immutable=1", query, since, batch_size)
+
+#####################################################################################
+# THIS FUNCTION READS THE VISITS NEWER THAN LAST VISIT (IN SECONDS SINCE THE EPOCH)
+# FROM A CHROMIUM OR FIREFOX HISTORY DATABASE WITHOUT COPYING IT
+# IT YIELDS BATCHES OF (VISIT TIME, URL, TITLE) STRAIGHT FROM THE DATABASE, OLDEST
+# FIRST, THE VISIT TIME IS STILL IN THE BROWSER'S OWN CLOCK
+#####################################################################################
+def query_native_history(history_path, query, epoch_offset, last_visit, batch_size):
+    # both browsers store microseconds
+    since = round((last_visit + epoch_offset) * 1000000)
+    # mode=ro still takes a shared lock, so visits in the write ahead log are seen
+    batches = query_history_database(Path(history_path).absolute().as_uri() + "?mode=ro", query, since, batch_size)
+    try:
+        # a locked database says so on the first batch
+        first_batch = next(batches, [])
+    except sqlite3.OperationalError as e:
+        if "locked" not in str(e):
+            raise
+        batches = query_history_snapshot(history_path, query, since, batch_size)
+        first_batch = next(batches, [])
+
+    with contextlib.closing(batches):
+        rows = first_batch
+        while rows:
+            yield rows
+            rows = next(batches, [])
+
+#####################################################################################
+# THIS FUNCTION DOES THE SAME AS query_native_history() BUT THE ROWS IT YIELDS LOOK
+# THE SAME AS THE ONES FROM THE BROWSER HISTORY LIBRARY
+#####################################################################################
+def fetch_native_history(history_path, query, epoch_offset, last_visit, batch_size):
+    for rows in query_native_history(history_path, query, epoch_offset, last_visit, batch_size):
+        # convert the browser's clock into timezone aware datetimes
+        yield [
+            (datetime.fromtimestamp(visit / 1000000 - epoch_offset, timezone.utc), url, title)
+            for visit, url, title in rows
+        ]
+
+#####################################################################################
+# THIS CLASS HOLDS A BATCH OF VISITS AS COLUMNS INSTEAD OF ONE TUPLE PER VISIT
+# THE VISIT TIMES ARE ONE ARRAY OF MICROSECONDS SINCE THE EPOCH, OLDEST FIRST, AND
+# THE URLS AND THE TITLES ARE EACH ONE STRING WITH THE VALUES SEPARATED BY A NUL
+# CHARACTER PLUS AN ARRAY OF WHERE EVERY VALUE STARTS (AND ONE MORE FOR THE END)
+# SO A BATCH IS A HANDFUL OF OBJECTS NO MATTER HOW MANY VISITS IT HOLDS, AND THE
+# MATCHER CAN SCAN A WHOLE COLUMN WITH ONE REGEX CALL
+# ALERT SITES ONLY CONTAIN LETTERS, DIGITS, DOTS AND DASHES SO A MATCH NEVER
+# CROSSES FROM ONE VALUE INTO THE NEXT
+#####################################################################################
+class HistoryBatch:
+    SEPARATOR = "\x00"
+
+    def __init__(self, source_key, visit_times, urls, titles):
+        self.source_key = source_key
+        self.visit_times = visit_times
+        self.url_text, self.url_offsets = self.pack_column(urls)
+        self.title_text, self.title_offsets = self.pack_column(list(map(str, titles)))
+
+    # THIS FUNCTION RETURNS THE NUL SEPARATED TEXT OF A COLUMN AND ITS OFFSETS
+    # EVERYTHING HERE RUNS INSIDE C LOOPS (map, accumulate), NOT ONE PYTHON STEP PER VISIT
+    @classmethod
+    def pack_column(cls, values):
+        text = cls.SEPARATOR.join(values) + cls.SEPARATOR
+        # every value takes up its length plus one for the separator
+        offsets = array("q", itertools.accumulate(map(operator.add, map(len, values), itertools.repeat(1)), initial=0))
+        return text, offsets
+
+    # THIS FUNCTION MAKES A BATCH OUT OF (VISIT TIME, URL, TITLE) ROWS THAT ARE IN TIME
+    # ORDER, THE VISIT TIME IS IN MICROSECONDS ON A CLOCK epoch_offset SECONDS BEHIND
+    # THE UNIX EPOCH. VISITS NOT NEWER THAN LAST VISIT (IN SECONDS) ARE LEFT OUT
+    # THE ROWS ARE SORTED, SO THAT IS ONE BINARY SEARCH INSTEAD OF A TEST PER ROW
+    @classmethod
+    def from_rows(cls, source_key, rows, epoch_offset, last_visit):
+        if not rows:
+            return cls(source_key, array("q"), [], [])
+        # turn the rows into columns
+        times, urls, titles = zip(*rows)
+        visit_times = array("q", map(operator.sub, times, itertools.repeat(epoch_offset * 1000000)))
+        first_new = bisect.bisect_right(visit_times, round(last_visit * 1000000))
+        return cls(source_key, visit_times[first_new:], urls[first_new:], titles[first_new:])
+
+    def __len__(self):
+        return len(self.visit_times)
+
+    # THIS FUNCTION RETURNS ALL THE URLS AS A LIST
+    def urls(self):
+        return self.url_text.split(self.SEPARATOR)[:-1]
+
+    # THIS FUNCTION RETURNS THE NUMBER OF THE VISIT A POSITION IN A COLUMN'S TEXT BELONGS TO
+    @staticmethod
+    def find_row(offsets, position):
+        return bisect.bisect_right(offsets, position) - 1
+
+    # THIS FUNCTION RETURNS ONE VISIT AS A (DATETIME, URL, TITLE, SOURCE KEY) TUPLE
+    # SO IT CAN GO INTO THE LEDGER LIKE ANY OTHER HISTORY ITEM
+    def row(self, index):
+        return (
+            datetime.fromtimestamp(self.visit_times[index] / 1000000, timezone.utc),
+            self.url_text[self.url_offsets[index]:self.url_offsets[index + 1] - 1],
+            self.title_text[self.title_offsets[index]:self.title_offsets[index + 1] - 1],
+            self.source_key,
+        )
+
+#####################################################################################
+# THIS FUNCTION READS ONE PROFILE AND YIELDS BATCHES OF ITS NEW VISITS, OLDEST FIRST
+# THE VISITS ALREADY HAVE THE browser:profile KEY ADDED SO EVERY VISIT KNOWS
+# WHERE IT CAME FROM
+# IN BATCH MODE EVERY BATCH IS A HistoryBatch, OTHERWISE IT IS A LIST OF TUPLES
+#####################################################################################
+def read_history_source(source_key, browser, history_path, last_visit, batch_size, batch_mode=False):
+    native_query = NATIVE_HISTORY_QUERIES.get(browser.history_file)
+    if native_query is not None and batch_mode:
+        # the rows never have to become datetimes at all
+        raw_batches = query_native_history(history_path, native_query[0], native_query[1], last_visit, batch_size)
+        with contextlib.closing(raw_batches):
+            for rows in raw_batches:
+                batch = HistoryBatch.from_rows(source_key, rows, native_query[1], last_visit)
+                if len(batch):
+                    yield batch
+        return
+
+    if native_query is not None:
+        raw_batches = fetch_native_history(history_path, native_query[0], native_query[1], last_visit, batch_size)
+    else:
+        # the library reads everything at once anyway, it only has to be put in order
+        histories = browser.fetch_history(history_paths=[history_path], sort=False).histories
+        histories.sort(key=lambda history: history[0])
+        raw_batches = (histories[i:i + batch_size] for i in range(0, len(histories), batch_size))
+
+    with contextlib.closing(raw_batches):
+        for raw_batch in raw_batches:
+            if batch_mode:
+                rows = [(round(history[0].timestamp() * 1000000), history[1], history[2]) for history in raw_batch]
+                batch = HistoryBatch.from_rows(source_key, rows, 0, last_visit)
+            else:
+                # only keep the items newer than the watermark
+                batch = [(history[0], history[1], history[2], source_key)
+                         for history in raw_batch if history[0].timestamp() > last_visit]
+            if len(batch):
+                yield batch
+
+#####################################################################################
+# THIS FUNCTION IS WHAT RUNS ON A HISTORY WORKER THREAD
+# IT READS ONE PROFILE AND PUTS ("rows", BATCH) FOR EVERY BATCH AND THEN EITHER
+# ("done", (ROWS READ, SECONDS SPENT READING)) OR ("error", THE ERROR) ON THE QUEUE
+# READING SINCE HOLDS WHEN THE WORKER STARTED ITS CURRENT READ, OR NONE WHILE IT
+# IS ONLY WAITING FOR ROOM ON THE QUEUE, SO A SLOW CONSUMER IS NOT MISTAKEN FOR A
+# SLOW PROFILE
+#####################################################################################
+def pump_history_source(job, batch_size, batch_mode, batches, cancel_event, reading_since):
+    source_key = job[0]
+    rows_read = 0
+    read_seconds = 0.0
+    try:
+        reading_since[source_key] = time.monotonic()
+        with contextlib.closing(read_history_source(*job, batch_size, batch_mode)) as source_batches:
+            for batch in source_batches:
+                read_seconds += time.monotonic() - reading_since[source_key]
+                rows_read += len(batch)
+                reading_since[source_key] = None
+                if not hand_over(batches, cancel_event, (source_key, "rows", batch)):
+                    return
+                reading_since[source_key] = time.monotonic()
+        read_seconds += time.monotonic() - reading_since[source_key]
+        event = (source_key, "done", (rows_read, read_seconds))
+    except Exception as e:
+        event = (source_key, "error", e)
+    reading_since[source_key] = None
+    hand_over(batches, cancel_event, event)
+
+#####################################################################################
+# THIS FUNCTION PUTS AN ITEM ON THE QUEUE, WAITING FOR ROOM UNLESS THE CYCLE IS
+# CANCELLED. IT RETURNS FALSE IF THE ITEM WAS DROPPED BECAUSE OF THAT
+#####################################################################################
+def hand_over(batches, cancel_event, item):
+    while not cancel_event.is_set():
+        try:
+            batches.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+#####################################################################################
+# THIS CLASS READS THE PROFILES ON A POOL OF THREADS, ALL AT THE SAME TIME
+# SQLITE LETS GO OF THE GIL WHILE IT QUERIES, SO THREADS ARE ENOUGH
+# THE WORKERS HAND THEIR BATCHES OVER THROUGH A SMALL QUEUE, SO A WORKER THAT GETS
+# AHEAD OF THE MATCHER WAITS INSTEAD OF PILING UP ROWS
+# A PROFILE THAT GOES SOURCE TIMEOUT SECONDS WITHOUT PRODUCING A BATCH (A DATABASE
+# LOCKED BY THE RUNNING BROWSER FOR EXAMPLE) IS GIVEN UP ON FOR THIS CYCLE AND IT
+# IS NOT READ AGAIN UNTIL THE SLOW READ ENDS. NONE MEANS NO TIMEOUT
+#####################################################################################
+class HistoryCollector:
+    def __init__(self, workers, source_timeout):
+        # only loaded when history is read
+        from concurrent.futures import ThreadPoolExecutor
+        self.workers = max(1, workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="history")
+        self.source_timeout = source_timeout
+        # source key -> a read that timed out and is still running
+        self.slow_reads = {}
+
+    # THIS FUNCTION TAKES (SOURCE KEY, BROWSER, HISTORY PATH, LAST VISIT) FOR EVERY
+    # PROFILE AND YIELDS (SOURCE KEY, KIND, VALUE) AS THE WORKERS PRODUCE THEM, SEE
+    # pump_history_source(). SETTING THE CANCEL EVENT MAKES THE WORKERS STOP READING
+    def stream_sources(self, jobs, batch_size, batch_mode, cancel_event):
+        batches = queue.Queue(maxsize=self.workers * 4)
+        reading_since = {}
+        running = {}
+        for job in jobs:
+            source_key = job[0]
+            slow_read = self.slow_reads.get(source_key)
+            if slow_read is not None:
+                if not slow_read.done():
+                    yield source_key, "error", TimeoutError("the last read has not finished yet")
+                    continue
+                del self.slow_reads[source_key]
+            running[source_key] = self.executor.submit(pump_history_source, job, batch_size, batch_mode,
+                                                       batches, cancel_event, reading_since)
+
+        try:
+            while running:
+                try:
+                    source_key, kind, value = batches.get(timeout=1 if self.source_timeout is None
+                                                          else min(1, self.source_timeout))
+                except queue.Empty:
+                    source_key = None
+
+                # a profile that was given up on may still hand something over, it is ignored
+                if source_key in running:
+                    if kind != "rows":
+                        del running[source_key]
+                    yield source_key, kind, value
+
+                if self.source_timeout is None:
+                    continue
+                now = time.monotonic()
+                for source_key in list(running):
+                    started = reading_since.get(source_key)
+                    if started is not None and now - started > self.source_timeout:
+                        self.slow_reads[source_key] = running.pop(source_key)
+                        yield source_key, "error", TimeoutError("produced nothing for " + str(self.source_timeout) + " seconds")
+        finally:
+            # stops the workers that are still reading
+            cancel_event.set()
+
+    # THIS FUNCTION STOPS THE POOL WITHOUT WAITING FOR A READ THAT IS STUCK
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+#####################################################################################
+# THIS FUNCTION STREAMS THE BROWSER HISTORY WE HAVE NOT SEEN YET, ONE VISIT AT A
+# TIME, AS THE PROFILES ARE READ. VISITS FROM DIFFERENT PROFILES ARE INTERLEAVED
+# EVERY PROFILE ONLY RETURNS VISITS NEWER THAN ITS WATERMARK, AND PROFILES WHOSE
+# DATABASE HAS NOT CHANGED ARE SKIPPED WITHOUT BEING READ AT ALL
+# CHROMIUM AND FIREFOX DATABASES ARE QUERIED DIRECTLY, ANYTHING ELSE (SAFARI)
+# STILL GOES THROUGH THE BROWSER HISTORY LIBRARY
+# THE TIME PERIOD PARAMETER IS IN MINUTES AND IS ONLY USED THE FIRST TIME A
+# PROFILE IS SEEN. IF METRICS ARE GIVEN, THE ROWS AND READ TIME OF EVERY PROFILE
+# ARE RECORDED. WITHOUT A COLLECTOR THE PROFILES ARE READ ONE AT A TIME
+# IN BATCH MODE THE STREAM YIELDS A HistoryBatch AT A TIME INSTEAD OF SINGLE VISITS
+#
+# THE WATERMARKS DICTIONARY IS UPDATED IN PLACE WHEN THE STREAM ENDS, EVERY
+# PROFILE MOVES UP TO THE LAST VISIT THAT WAS CONSUMED
+# THE CONSUMER CAN STOP EARLY BY SETTING THE CANCEL EVENT AND CLOSING THE STREAM,
+# THAT MEANS THE REST OF THE HISTORY UP TO NOW DOES NOT MATTER (EVERY SITE HAS
+# ALREADY MATCHED) SO PROFILES THAT WERE CUT SHORT MOVE UP TO THE START OF THE CYCLE
+# A STREAM CLOSED WITHOUT THE CANCEL EVENT (AN ERROR) LEAVES THE WATERMARKS ALONE
+#####################################################################################
+def stream_browser_history(time_period, watermarks, metrics=None, collector=None, cancel_event=None,
+                           batch_mode=False):
+    print("Checking installed browsers")
 
     # the timezone must be added so the object is not naive
     current_time = datetime.now(timezone.utc)
+    first_visit = (current_time - timedelta(minutes=time_period)).timestamp()
+    if cancel_event is None:
+        cancel_event = threading.Event()
+
+    jobs = []
+    signatures = {}
+    for source_key, browser, history_path in get_history_sources():
+        watermark = watermarks.get(source_key, {})
+        signature = get_file_signature(history_path)
+
+        # if the database has not been touched then there is nothing new in it
+        if watermark.get("signature") == signature:
+            continue
+
+        # new profiles start at the beginning of the time period
+        signatures[source_key] = signature
+        jobs.append((source_key, browser, history_path, watermark.get("last_visit", first_visit)))
+
+    own_collector = collector is None
+    if own_collector:
+        collector = HistoryCollector(1, None)
+    events = collector.stream_sources(jobs, HISTORY_BATCH_SIZE, batch_mode, cancel_event)
+    last_rows = {}
+    finished = set()
+    unread = {job[0] for job in jobs}
+    completed = False
+    try:
+        for source_key, kind, value in events:
+            if kind == "rows" and batch_mode:
+                last_rows[source_key] = value.row(len(value) - 1)
+                yield value
+                continue
+            if kind == "rows":
+                for history in value:
+                    last_rows[source_key] = history
+                    yield history
+                continue
+
+            unread.discard(source_key)
+            if kind == "done":
+                finished.add(source_key)
+                rows_read, read_seconds = value
+                if metrics is not None:
+                    metrics.count("source_read_seconds_total", read_seconds, source=source_key)
+                    metrics.set_gauge("source_last_read_seconds", read_seconds, source=source_key)
+                    metrics.count("rows_scanned_total", rows_read, source=source_key)
+            # a broken profile should not hide the others, anything else is a real bug
+            elif isinstance(value, (sqlite3.Error, OSError)):
+                print("  [!] Could not read " + source_key + " history: %s" % value)
+                if metrics is not None:
+                    metrics.count("source_timeouts_total" if isinstance(value, TimeoutError) else "source_errors_total",
+                                  source=source_key)
+            else:
+                raise value
+        completed = True
+    finally:
+        # the consumer sets the cancel event before closing, the collector sets it again on the way out
+        stopped_early = cancel_event.is_set()
+        events.close()
+        if own_collector:
+            collector.close()
+
+        # the watermarks are only ever touched here, on the consuming thread
+        if completed or stopped_early:
+            for source_key, _, _, last_visit in jobs:
+                if source_key in last_rows:
+                    last_visit = max(last_visit, last_rows[source_key][0].timestamp())
+                if source_key in finished:
+                    watermarks[source_key] = {"last_visit": last_visit, "signature": signatures[source_key]}
+                elif source_key in unread and stopped_early:
+                    # no signature, so the profile is read again next cycle from here
+                    watermarks[source_key] = {"last_visit": max(last_visit, current_time.timestamp())}
+                elif source_key in last_rows:
+                    watermarks[source_key] = {"last_visit": last_visit}
 
-    # add the items from the browser history within the time period to the return list 
-    all_user_history = output.histories
-    for history in all_user_history:
-        if history[0] > current_time - timedelta(minutes=time_period):
-           returnlist.append(history) 
-
-    # returns a list of the browser history within the time period
+#####################################################################################
+# THIS FUNCTION CHECKS THE BROWSER HISTORY FOR VISITS WE HAVE NOT SEEN YET AND
+# RETURNS ALL OF THEM AS ONE LIST IN THE ORDER THEY HAPPENED
+# IT TAKES THE SAME PARAMETERS AS stream_browser_history()
+#####################################################################################
+def get_browser_history(time_period, watermarks, metrics=None, collector=None):
+    returnlist = list(stream_browser_history(time_period, watermarks, metrics, collector))
+    returnlist.sort(key=lambda history: history[0])
     return returnlist
 
 
 
 
 #####################################################################################
-# THIS FUNCTION CHECKS TO SEE IF THE ALERT SITE IS IN THE BROWSER HISTORY
-# OF A GIVEN LIST AND RETURNS A BOOLEAN
+# THIS FUNCTION TURNS A LIST OF SITES INTO ONE REGEX SHAPED LIKE A TRIE
+# "amazon" AND "amazonsmile" BECOME amazon(?:smile)? SO THE REGEX ENGINE WALKS
+# ONE CHARACTER AT A TIME INSTEAD OF TRYING EVERY SITE AT EVERY POSITION
+# THE OPTIONAL PARTS ARE GREEDY, SO THE LONGEST SITE AT A POSITION WINS
 #####################################################################################
-def find_alerts(my_recent_browser_history, alert_site_list):
-    # first check to see if there are any items in the browser history list
-    # if there are no items then return false because the result is not present
-    if len(my_recent_browser_history) == 0:
-        print("  [*] No new browser history found")
-        return []
+def build_trie_pattern(site_list):
+    # build the trie, an empty key marks the end of a site
+    trie = {}
+    for site in site_list:
+        node = trie
+        for char in site:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    # turn every node of the trie into a group of alternatives
+    def node_to_pattern(node):
+        branches = [re.escape(char) + node_to_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # a site ends here, so the rest is optional
+        if "" in node:
+            return "(?:" + pattern + ")?"
+        return pattern
+
+    return node_to_pattern(trie)
 
-    # if there are items in the browser history list then check to see if the alert site is in the list
-    else:
-        return_list = []
-        for history in my_recent_browser_history:
-            for alert_site in alert_site_list:
-                if alert_site in str(history[2]).lower():
-                    return_list.append(alert_site)
-                    break
-    
-    # if the return list is empty then there are no alerts in the browser history
-    if return_list == []:
+#####################################################################################
+# THIS CLASS FINDS EVERY ALERT SITE IN A PIECE OF TEXT WITH A SINGLE SCAN
+# IT IS BUILT ONCE FROM THE CLEANED ALERT SITE LIST AND REUSED EVERY CYCLE
+# ALL THE SITES ARE COMPILED INTO ONE REGEX, SO THE COST OF A SCAN NO LONGER
+# GROWS WITH THE NUMBER OF SITES THE WAY A LOOP OF "IN" TESTS DOES
+#####################################################################################
+class AlertMatcher:
+    def __init__(self, alert_site_list):
+        self.alert_sites = sorted(set(site.lower() for site in alert_site_list))
+        pattern = build_trie_pattern(self.alert_sites)
+
+        # this one only answers "is there anything at all", which is all most text needs
+        self.any_site = re.compile(pattern)
+        # this one is a lookahead so it finds a match starting at every position,
+        # including matches that overlap each other
+        self.every_site = re.compile("(?=(" + pattern + "))")
+
+        # the longest site at a position hides the shorter sites inside it
+        # (amazon inside amazonsmile) so remember which sites each one contains
+        self.contained_sites = {}
+        for site in self.alert_sites:
+            self.contained_sites[site] = {other for other in self.alert_sites if other in site}
+
+    # THIS FUNCTION RETURNS THE SET OF ALERT SITES FOUND IN THE TITLE OF A HISTORY ITEM
+    def match_history(self, history):
+        return self.scan(str(history[2]))
+
+    # THIS FUNCTION RETURNS (SITE, VISIT NUMBER) FOR EVERY ALERT SITE IN THE TITLES
+    # OF A HistoryBatch, THE WHOLE TITLE COLUMN IS SCANNED IN ONE GO
+    def match_batch(self, batch):
+        text = batch.title_text.lower()
+        # a few characters grow when lowercased, that would throw the offsets off
+        if len(text) != len(batch.title_text):
+            return [(site, index) for index in range(len(batch)) for site in self.match_history(batch.row(index))]
+        if not self.alert_sites or self.any_site.search(text) is None:
+            return []
+        found = set()
+        for match in self.every_site.finditer(text):
+            index = batch.find_row(batch.title_offsets, match.start())
+            for site in self.contained_sites[match.group(1)]:
+                found.add((site, index))
+        return sorted(found, key=lambda hit: hit[1])
+
+    # THIS FUNCTION RETURNS THE SET OF ALERT SITES FOUND IN THE TEXT
+    def scan(self, text):
+        text = text.lower()
+        # an empty site list would compile to a regex that matches everything
+        if not self.alert_sites or self.any_site.search(text) is None:
+            return set()
+        found_sites = set()
+        for match in self.every_site.finditer(text):
+            found_sites |= self.contained_sites[match.group(1)]
+        return found_sites
+
+#####################################################################################
+# THIS REGEX PICKS THE NETWORK LOCATION (user@host:port) OUT OF A URL, IT IS MUCH
+# CHEAPER THAN urlsplit AND IS ALL THAT IS NEEDED TO FIND THE CACHED HOST
+#####################################################################################
+URL_NETLOC = re.compile(r"[^:/?#]*://([^/?#]*)")
+
+#####################################################################################
+# THIS FUNCTION RETURNS THE LOWERCASE HOST OF A URL, OR NONE IF IT HAS NO HOST
+#####################################################################################
+def get_url_host(url):
+    try:
+        host = urlsplit(url).hostname
+    except ValueError:
+        return None
+    if host is None:
+        return None
+    return host.rstrip(".")
+
+#####################################################################################
+# THIS CLASS MATCHES ALERT SITES AGAINST THE HOST OF EVERY HISTORY URL
+# A SITE WITH A DOT IN IT (amazon.com) MATCHES THAT DOMAIN AND ITS SUBDOMAINS
+# A SITE WITHOUT ONE (amazon) MATCHES ANY PART OF THE HOST, SO IT STILL FINDS
+# amazon.co.uk AND smile.amazon.de
+# HOSTS REPEAT A LOT BUT WHOLE URLS HARDLY EVER DO, SO ONLY THE NETWORK LOCATION IS
+# CUT OUT OF EVERY URL AND THE HOST PARSING AND LOOKUP ARE CACHED ON THAT
+#####################################################################################
+class HostMatcher:
+    def __init__(self, alert_site_list, cache_size=HOST_CACHE_SIZE):
+        self.alert_sites = sorted(set(site.lower() for site in alert_site_list))
+        self.alert_domains = {site for site in self.alert_sites if "." in site}
+        self.alert_names = {site for site in self.alert_sites if "." not in site}
+
+        # bounded cache so a long running monitor does not grow forever
+        self.get_netloc_sites = functools.lru_cache(maxsize=cache_size)(self.find_netloc_sites)
+
+    # THIS FUNCTION RETURNS THE ALERT SITES FOR A NETWORK LOCATION
+    def find_netloc_sites(self, netloc):
+        host = get_url_host("//" + netloc)
+        if host is None:
+            return frozenset()
+        return self.find_host_sites(host)
+
+    # THIS FUNCTION RETURNS THE ALERT SITES FOR A URL
+    def find_url_sites(self, url):
+        netloc = URL_NETLOC.match(url)
+        if netloc is None:
+            return frozenset()
+        return self.get_netloc_sites(netloc.group(1))
+
+    # THIS FUNCTION LOOKS EVERY SUFFIX AND EVERY LABEL OF A HOST UP IN THE SITE SETS
+    def find_host_sites(self, host):
+        found_sites = set()
+        labels = host.split(".")
+        for i in range(len(labels)):
+            suffix = ".".join(labels[i:])
+            if suffix in self.alert_domains:
+                found_sites.add(suffix)
+            if labels[i] in self.alert_names:
+                found_sites.add(labels[i])
+        return frozenset(found_sites)
+
+    # THIS FUNCTION RETURNS THE SET OF ALERT SITES FOUND IN THE URL OF A HISTORY ITEM
+    def match_history(self, history):
+        return self.find_url_sites(str(history[1]))
+
+    # THIS FUNCTION RETURNS (SITE, VISIT NUMBER) FOR EVERY ALERT SITE IN THE URLS OF A
+    # HistoryBatch, THE HOSTS STILL HAVE TO BE LOOKED AT ONE BY ONE BUT NO TUPLES OR
+    # DATETIMES ARE MADE FOR THE VISITS THAT DO NOT MATCH
+    def match_batch(self, batch):
+        found = []
+        find_url_sites = self.find_url_sites
+        for index, url in enumerate(batch.urls()):
+            for site in find_url_sites(url):
+                found.append((site, index))
+        return found
+
+#####################################################################################
+# THIS FUNCTION BUILDS THE MATCHER FOR THE CONFIGURED MATCH MODE
+#####################################################################################
+def build_alert_matcher(alert_site_list, match_mode):
+    if match_mode == "host":
+        return HostMatcher(alert_site_list)
+    if match_mode != "text":
+        print("  [!] MATCH_MODE must be text or host")
+        print("  [!] Defaulting to text")
+    return AlertMatcher(alert_site_list)
+
+#####################################################################################
+# THIS FUNCTION YIELDS (SITE, HISTORY ITEM) FOR EVERY ALERT SITE IN THE HISTORY
+# IT TAKES ANY ITERABLE, SO THE HISTORY CAN BE MATCHED WHILE IT IS STILL BEING READ
+#####################################################################################
+def iter_alerts(history_rows, alert_matcher):
+    match_history = alert_matcher.match_history
+    for history in history_rows:
+        for site in match_history(history):
+            yield site, history
+
+#####################################################################################
+# THIS FUNCTION SAYS WHAT A CYCLE FOUND
+#####################################################################################
+def report_alerts(row_count, found_sites):
+    if row_count == 0:
+        print("  [*] No new browser history found")
+    elif not found_sites:
         print("  [*] No alerts found in browser history")
-        return []
-    # if the return list is not empty then there are alerts in the browser history
     else:
-        return_list = list(set(return_list))
-        print( "  [*] Found " + make_list_readable(return_list) + " in browser history!")
-        return return_list
+        print( "  [*] Found " + make_list_readable(sorted(found_sites)) + " in browser history!")
+
+#####################################################################################
+# THIS FUNCTION CHECKS TO SEE IF THE ALERT SITES ARE IN THE BROWSER HISTORY
+# OF A GIVEN LIST AND RETURNS A LIST OF (SITE, HISTORY ITEM) FOR EVERY MATCH
+#####################################################################################
+def find_alerts(my_recent_browser_history, alert_matcher):
+    alert_hits = list(iter_alerts(my_recent_browser_history, alert_matcher))
+    report_alerts(len(my_recent_browser_history), set(site for site, _ in alert_hits))
+    return alert_hits
+
+#####################################################################################
+# THIS FUNCTION RUNS A HISTORY STREAM THROUGH THE MATCHER AS IT ARRIVES, ONLY THE
+# HITS ARE KEPT AND THEY ARE RECORDED IN THE LEDGER ONCE THE SCAN IS OVER, SO THE
+# STATE DATABASE IS NEVER LOCKED FOR THE LENGTH OF A SCAN
+# ONCE EVERY ALERT SITE HAS MATCHED THE REST OF THE HISTORY COULD ONLY REPEAT THEM,
+# SO THE CANCEL EVENT IS SET AND THE SCAN STOPS THERE. A DIGEST NEEDS EVERY VISIT TO
+# COUNT THEM, SO IT PASSES stop_early=False AND THE WHOLE HISTORY IS READ
+# IT RETURNS (NEW VISITS, ROWS READ, MATCHES FOUND), THE NEW VISITS ARE A DICTIONARY
+# OF SITE -> [COUNT, FIRST SEEN, LAST SEEN] IN THE ORDER THE SITES WERE FOUND
+# IF THE SCAN FAILS THE HITS ARE THROWN AWAY, IF IT WORKS THE CALLER SAVES THEM WITH
+# save_hits() ONCE THE ALERTS ARE QUEUED
+# THE STREAM CAN HOLD SINGLE VISITS OR WHOLE HistoryBatch COLUMNS (BATCH MODE)
+# WITH METRICS THE SCAN IS SPLIT INTO THE get_history, find_alerts AND ledger STAGES,
+# THE TIME SPENT WAITING FOR THE STREAM, MATCHING AND RECORDING THE HITS
+#####################################################################################
+def scan_history(history_stream, alert_matcher, alert_ledger, cancel_event, stop_early=True, metrics=None):
+    site_count = len(alert_matcher.alert_sites) if stop_early else 0
+    row_count = 0
+    hit_count = 0
+    found_sites = set()
+    site_visits = {}
+    pending_hits = []
+    stopped_early = False
+    match_history = alert_matcher.match_history
+    perf_counter = time.perf_counter
+    scan_start = perf_counter()
+    match_seconds = 0.0
+    try:
+        for history in history_stream:
+            match_start = perf_counter()
+            if isinstance(history, HistoryBatch):
+                row_count += len(history)
+                for site, index in alert_matcher.match_batch(history):
+                    hit_count += 1
+                    found_sites.add(site)
+                    pending_hits.append((site, history.row(index)))
+            else:
+                row_count += 1
+                for site in match_history(history):
+                    hit_count += 1
+                    found_sites.add(site)
+                    pending_hits.append((site, history))
+            match_seconds += perf_counter() - match_start
+            if site_count and len(found_sites) == site_count:
+                cancel_event.set()
+                stopped_early = True
+                break
+        ledger_start = perf_counter()
+        count_new_visits(site_visits, alert_ledger.record_hits(pending_hits))
+        ledger_seconds = perf_counter() - ledger_start
+    except BaseException:
+        alert_ledger.forget_hits()
+        raise
+
+    if metrics is not None:
+        metrics.record_stage("get_history", ledger_start - scan_start - match_seconds)
+        metrics.record_stage("find_alerts", match_seconds)
+        metrics.record_stage("ledger", ledger_seconds)
+    report_alerts(row_count, found_sites)
+    if stopped_early:
+        print("  [*] Every alert site matched, the rest of the history was skipped")
+    return site_visits, row_count, hit_count
+
+#####################################################################################
+# THIS FUNCTION ADDS (SITE, VISIT TIME) PAIRS TO THE COUNT AND FIRST AND LAST VISIT
+# OF EVERY SITE
+#####################################################################################
+def count_new_visits(site_visits, new_visits):
+    for site, visit_time in new_visits:
+        if site in site_visits:
+            seen = site_visits[site]
+            seen[0] += 1
+            seen[1] = min(seen[1], visit_time)
+            seen[2] = max(seen[2], visit_time)
+        else:
+            site_visits[site] = [1, visit_time, visit_time]
+
+
+#####################################################################################
+# THIS CLASS HOLDS ALL THE ALERT PROFILES AND THE ONE MATCHER THEY SHARE
+# THE MATCHER IS BUILT FROM EVERY SITE OF EVERY PROFILE, SO A CYCLE COSTS ONE READ
+# AND ONE MATCHING PASS NO MATTER HOW MANY PROFILES THERE ARE, AND THE SITES IT
+# FINDS ARE HANDED BACK TO THE PROFILES THAT ASKED FOR THEM
+#####################################################################################
+class AlertProfiles:
+    def __init__(self, profiles, match_mode):
+        self.profiles = profiles
+        # site -> the profiles watching it
+        self.site_profiles = {}
+        for profile in profiles:
+            for site in profile["alert_sites"]:
+                self.site_profiles.setdefault(site, []).append(profile)
+        self.matcher = build_alert_matcher(sorted(self.site_profiles), match_mode)
+
+    # THIS FUNCTION RETURNS (PROFILE, ITS SITES) FOR EVERY PROFILE WATCHING ANY OF THESE SITES
+    def split_by_profile(self, site_list):
+        profile_sites = {}
+        for site in site_list:
+            for profile in self.site_profiles.get(site, []):
+                profile_sites.setdefault(profile["name"], []).append(site)
+        return [(profile, profile_sites[profile["name"]]) for profile in self.profiles if profile["name"] in profile_sites]
+
+#####################################################################################
+# THIS FUNCTION TURNS "amazon=60,ebay=5" INTO {"amazon": 60, "ebay": 5}
+#####################################################################################
+def parse_site_windows(setting):
+    site_windows = {}
+    for entry in setting.split(","):
+        if entry.strip() == "":
+            continue
+        site, _, minutes = entry.partition("=")
+        try:
+            site_windows[site.strip().lower()] = int(minutes)
+        except ValueError:
+            print("  [!] Ignoring suppression window " + entry.strip() + ", it must look like site=minutes")
+    return site_windows
+
+#####################################################################################
+# THIS CLASS REMEMBERS EVERY VISIT THAT HAS ALREADY BEEN ALERTED ABOUT
+# IT LIVES IN AN SQLITE DATABASE SO A RESTART OR AN OVERLAPPING WINDOW NEVER SENDS
+# THE SAME VISIT TWICE, AND IT KNOWS WHEN EVERY PROFILE WAS LAST ALERTED ABOUT EVERY
+# SITE SO A SITE CAN BE KEPT QUIET FOR A WHILE AFTER AN ALERT
+# THE VISITS ARE SHARED BY ALL PROFILES BECAUSE THEY ALL LOOK AT THE SAME SCAN
+#####################################################################################
+class AlertLedger:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=STATE_BUSY_TIMEOUT)
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS alert_ledger (
+                    browser TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    visit_time REAL NOT NULL,
+                    site TEXT NOT NULL,
+                    recorded_at REAL NOT NULL,
+                    PRIMARY KEY (browser, url, visit_time, site)
+                );
+                CREATE TABLE IF NOT EXISTS profile_alerts (
+                    profile TEXT NOT NULL,
+                    site TEXT NOT NULL,
+                    last_alerted REAL NOT NULL,
+                    PRIMARY KEY (profile, site)
+                );
+            """)
+            # before there were profiles the last alerts were kept per site only
+            if self.connection.execute("SELECT name FROM sqlite_master WHERE name = 'site_alerts'").fetchone():
+                self.connection.execute("INSERT OR IGNORE INTO profile_alerts SELECT ?, site, last_alerted FROM site_alerts",
+                                        (DEFAULT_PROFILE,))
+                self.connection.execute("DROP TABLE site_alerts")
+
+    # THIS FUNCTION RECORDS HITS WITHOUT SAVING THEM YET AND RETURNS (SITE, VISIT TIME)
+    # FOR EVERY VISIT THAT WAS NOT RECORDED BEFORE. IT CAN BE CALLED MANY TIMES IN A CYCLE,
+    # save_hits() SAVES EVERYTHING AND forget_hits() THROWS IT AWAY
+    def record_hits(self, alert_hits):
+        now = time.time()
+        new_visits = []
+        for site, history in alert_hits:
+            visit_time = history[0].timestamp()
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO alert_ledger VALUES (?, ?, ?, ?, ?)",
+                (history[3], str(history[1]), visit_time, site, now))
+            if cursor.rowcount == 1:
+                new_visits.append((site, visit_time))
+        return new_visits
+
+    # THIS FUNCTION THROWS AWAY THE HITS RECORDED SINCE THE LAST SAVE
+    def forget_hits(self):
+        self.connection.rollback()
+
+    # THIS FUNCTION SAVES THE RECORDED HITS
+    def save_hits(self):
+        with self.connection:
+            # forget visits that are too old to ever be read again
+            self.connection.execute("DELETE FROM alert_ledger WHERE visit_time < ?",
+                                    (time.time() - LEDGER_RETENTION_DAYS * 86400,))
+
+    # THIS FUNCTION RETURNS THE SITES THIS PROFILE SHOULD BE ALERTED ABOUT
+    # A SITE IS LEFT OUT IF THE PROFILE WAS ALERTED ABOUT IT MORE RECENTLY THAN
+    # ITS SUPPRESSION WINDOW
+    def filter_suppressed(self, profile, site_list):
+        now = time.time()
+        alert_sites = []
+        for site in site_list:
+            window = profile["site_windows"].get(site, profile["suppression_window"])
+            row = self.connection.execute("SELECT last_alerted FROM profile_alerts WHERE profile = ? AND site = ?",
+                                          (profile["name"], site)).fetchone()
+            if row is not None and now - row[0] < window * 60:
+                print("  [*] Not alerting " + profile["user_name"] + " about " + site.upper() + " again within " + str(window) + " minutes")
+                continue
+            alert_sites.append(site)
+        return alert_sites
+
+    # THIS FUNCTION RECORDS THAT THIS PROFILE WAS JUST ALERTED ABOUT THESE SITES
+    # IT IS SAVED TOGETHER WITH THE HITS BY save_hits()
+    def mark_alerted(self, profile_name, site_list):
+        now = time.time()
+        self.connection.executemany("INSERT OR REPLACE INTO profile_alerts VALUES (?, ?, ?)",
+                                    [(profile_name, site, now) for site in site_list])
+
+
+#####################################################################################
+# THIS CLASS IS THE OUTBOX, A TABLE OF ALERTS THAT STILL HAVE TO BE SENT
+# IT SHARES THE STATE DATABASE WITH THE LEDGER, SO ALERTS THAT WERE QUEUED BUT NOT
+# SENT YET ARE STILL THERE AFTER A RESTART
+# EVERY ALERT IS A JSON PAYLOAD WITH THE SITES AND WHO TO SEND THEM TO
+#####################################################################################
+class AlertOutbox:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the detection loop adds alerts and the delivery thread sends them
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=STATE_BUSY_TIMEOUT, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS alert_outbox (
+                    id INTEGER PRIMARY KEY,
+                    recipient TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL
+                )
+            """)
+
+    # THIS FUNCTION ADDS AN ALERT TO THE OUTBOX
+    # GIVEN ANOTHER CONNECTION TO THE STATE DATABASE IT ADDS IT THERE WITHOUT SAVING, SO
+    # THE ALERT IS SAVED TOGETHER WITH WHATEVER ELSE THAT CONNECTION IS DOING
+    def add(self, payload, connection=None):
+        now = time.time()
+        row = (get_alert_recipient(payload), json.dumps(payload), now, now)
+        if connection is not None:
+            connection.execute(
+                "INSERT INTO alert_outbox (recipient, payload, created_at, next_attempt) VALUES (?, ?, ?, ?)", row)
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO alert_outbox (recipient, payload, created_at, next_attempt) VALUES (?, ?, ?, ?)", row)
+
+    # THIS FUNCTION RETURNS THE ALERTS THAT ARE READY TO GO, GROUPED BY RECIPIENT
+    # A GROUP IS ONLY READY ONCE ITS OLDEST ALERT HAS WAITED COALESCE SECONDS,
+    # SO MATCHES THAT ARRIVE CLOSE TOGETHER END UP IN THE SAME EMAIL
+    # IT ALSO RETURNS HOW MANY SECONDS TO WAIT UNTIL THE NEXT GROUP IS READY
+    def take_ready(self, coalesce_seconds):
+        now = time.time()
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, recipient, payload, created_at, attempts, next_attempt FROM alert_outbox ORDER BY id").fetchall()
+
+        groups = {}
+        for row in rows:
+            groups.setdefault(row[1], []).append(row)
+
+        ready_groups = []
+        next_ready = None
+        for recipient, group in groups.items():
+            ready_at = max(min(row[3] for row in group) + coalesce_seconds, max(row[5] for row in group))
+            if ready_at <= now:
+                ready_groups.append(group)
+            elif next_ready is None or ready_at - now < next_ready:
+                next_ready = ready_at - now
+        return ready_groups, next_ready
+
+    # THIS FUNCTION REMOVES ALERTS THAT WERE SENT (OR GIVEN UP ON)
+    def remove(self, alert_ids):
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM alert_outbox WHERE id = ?", [(alert_id,) for alert_id in alert_ids])
+
+    # THIS FUNCTION PUTS ALERTS BACK TO BE TRIED AGAIN AFTER A DELAY
+    # IT TAKES (ALERT ID, ATTEMPTS SO FAR) FOR EVERY ALERT
+    def retry_later(self, alert_attempts, delay):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE alert_outbox SET attempts = ?, next_attempt = ? WHERE id = ?",
+                [(attempts, time.time() + delay, alert_id) for alert_id, attempts in alert_attempts])
+
+    # THIS FUNCTION RETURNS HOW MANY ALERTS ARE STILL WAITING
+    def count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM alert_outbox").fetchone()[0]
+
+#####################################################################################
+# THIS FUNCTION RETURNS WHO AN ALERT GOES TO, ALERTS FOR THE SAME RECIPIENT ARE MERGED
+# TWO PROFILES CAN SEND TO THE SAME ADDRESS ABOUT DIFFERENT SHOPPERS, THOSE ARE
+# DIFFERENT EMAILS SO THE SHOPPER IS PART OF THE RECIPIENT
+#####################################################################################
+def get_alert_recipient(payload):
+    return json.dumps([payload["user_email"], payload["shopper_name"]])
+
+#####################################################################################
+# THIS FUNCTION MERGES SEVERAL QUEUED ALERTS FOR ONE RECIPIENT INTO ONE
+# THE SITES ARE COMBINED IN THE ORDER THEY WERE FOUND, THEIR VISIT COUNTS ARE ADDED
+# UP AND THE REST COMES FROM THE NEWEST
+#####################################################################################
+def merge_alert_payloads(payloads):
+    merged = dict(payloads[-1])
+    merged["sites"] = []
+    merged["visits"] = {}
+    for payload in payloads:
+        for site in payload["sites"]:
+            if site not in merged["sites"]:
+                merged["sites"].append(site)
+        for site, (count, first_seen, last_seen) in payload.get("visits", {}).items():
+            if site in merged["visits"]:
+                seen = merged["visits"][site]
+                merged["visits"][site] = [seen[0] + count, min(seen[1], first_seen), max(seen[2], last_seen)]
+            else:
+                merged["visits"][site] = [count, first_seen, last_seen]
+    return merged
+
+#####################################################################################
+# THIS FUNCTION RETURNS HOW LONG TO WAIT BEFORE THE NEXT ATTEMPT
+# THE CEILING DOUBLES WITH EVERY ATTEMPT AND THE ACTUAL WAIT IS RANDOM BELOW IT
+# SO A BUNCH OF FAILED ALERTS DO NOT ALL COME BACK AT THE SAME MOMENT
+#####################################################################################
+def get_retry_delay(attempts, base_seconds, max_seconds):
+    ceiling = min(max_seconds, base_seconds * 2 ** attempts)
+    return random.uniform(ceiling / 2, ceiling)
+
+#####################################################################################
+# THIS CLASS IS THE BACKGROUND THREAD THAT EMPTIES THE OUTBOX
+# THE SEND FUNCTION GETS A MERGED PAYLOAD AND RETURNS TRUE IF IT WAS SENT
+# A SLOW OR BROKEN EMAIL SERVICE ONLY EVER HOLDS THIS THREAD UP, NEVER THE MONITOR
+#####################################################################################
+class AlertDeliveryWorker(threading.Thread):
+    def __init__(self, outbox, send_function, coalesce_seconds, max_attempts, retry_base_seconds, retry_max_seconds,
+                 digest_cycles=0):
+        super().__init__(name="alert-delivery", daemon=True)
+        self.outbox = outbox
+        self.send_function = send_function
+        self.coalesce_seconds = coalesce_seconds
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        # in digest mode nothing is sent until digest_cycles cycles have gone by
+        self.digest_cycles = digest_cycles
+        self.cycles_since_digest = 0
+        self.digest_due = threading.Event()
+        self.wake_up = threading.Event()
+        self.stopping = False
+
+    # THIS FUNCTION QUEUES AN ALERT AND WAKES THE THREAD UP
+    # WITH A CONNECTION THE ALERT BECOMES PART OF THAT CONNECTION'S TRANSACTION AND THE
+    # THREAD IS WOKEN UP BY wake() ONCE IT IS COMMITTED
+    def queue_alert(self, payload, connection=None):
+        self.outbox.add(payload, connection)
+        if connection is None:
+            self.wake_up.set()
+
+    # THIS FUNCTION WAKES THE THREAD UP TO LOOK AT THE OUTBOX AGAIN
+    def wake(self):
+        self.wake_up.set()
+
+    # THIS FUNCTION IS CALLED AT THE END OF EVERY CYCLE, IN DIGEST MODE IT LETS THE
+    # THREAD SEND EVERYTHING IT HAS BEEN HOLDING ONCE ENOUGH CYCLES HAVE GONE BY
+    def end_cycle(self):
+        if not self.digest_cycles:
+            return
+        self.cycles_since_digest += 1
+        if self.cycles_since_digest >= self.digest_cycles:
+            self.cycles_since_digest = 0
+            self.digest_due.set()
+            self.wake_up.set()
+
+    # THIS FUNCTION ASKS THE THREAD TO FINISH WHAT IT IS SENDING AND STOP
+    # ANYTHING STILL IN THE OUTBOX IS SENT THE NEXT TIME THE PROGRAM STARTS
+    def stop(self, timeout=10):
+        self.stopping = True
+        self.wake_up.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self.stopping:
+            # a state database that is busy or broken only holds the alerts up, the
+            # thread keeps going and tries again
+            try:
+                self.send_ready()
+            except sqlite3.Error as e:
+                print("  [!] Could not use the outbox, trying again in a minute: %s" % e)
+                self.wake_up.wait(60)
+                self.wake_up.clear()
+
+    # THIS FUNCTION SENDS WHATEVER IS READY, OR WAITS UNTIL SOMETHING COULD BE
+    def send_ready(self):
+        # a digest holds every alert until it is due, then sends all of them
+        if self.digest_cycles and not self.digest_due.is_set():
+            self.wake_up.wait()
+            self.wake_up.clear()
+            return
+        if self.digest_cycles:
+            self.digest_due.clear()
+            ready_groups, next_ready = self.outbox.take_ready(0)
+            if ready_groups:
+                print("  [*] Sending the digest of the last " + str(self.digest_cycles) + " cycles")
+            for group in ready_groups:
+                if self.stopping:
+                    break
+                self.deliver(group)
+            return
+        ready_groups, next_ready = self.outbox.take_ready(self.coalesce_seconds)
+        for group in ready_groups:
+            if self.stopping:
+                break
+            self.deliver(group)
+        # sleep until the next group is ready or a new alert shows up
+        if not ready_groups:
+            self.wake_up.wait(60 if next_ready is None else next_ready)
+            self.wake_up.clear()
+
+    # THIS FUNCTION REMOVES ALERTS THAT WENT OUT FROM THE OUTBOX
+    # IF THE DATABASE IS BUSY IT KEEPS TRYING, GOING BACK THROUGH send_ready() WOULD
+    # SEND THE SAME EMAIL AGAIN
+    def remove_sent(self, alert_ids):
+        while True:
+            try:
+                self.outbox.remove(alert_ids)
+                return
+            except sqlite3.Error as e:
+                if self.stopping:
+                    print("  [!] Could not take a sent alert out of the outbox, it may be sent again: %s" % e)
+                    return
+                print("  [!] Could not take a sent alert out of the outbox, trying again: %s" % e)
+                time.sleep(1)
+
+    # THIS FUNCTION SENDS ONE GROUP OF ALERTS AS A SINGLE EMAIL
+    # EVERY ALERT COUNTS ITS OWN ATTEMPTS, SO AN ALERT THAT JOINS A GROUP THAT HAS BEEN
+    # FAILING FOR A WHILE STILL GETS ALL OF ITS ATTEMPTS
+    def deliver(self, group):
+        alert_ids = [row[0] for row in group]
+        payload = merge_alert_payloads([json.loads(row[2]) for row in group])
+        if len(group) > 1:
+            print("  [*] Combining " + str(len(group)) + " alerts for " + payload["user_email"] + " into one email")
+
+        # anything going wrong in the send counts as a failed attempt
+        try:
+            sent = self.send_function(payload)
+        except Exception as e:
+            print("  [!] Sending alert failed: %s" % e)
+            sent = False
+
+        if sent:
+            self.remove_sent(alert_ids)
+            return
+
+        given_up = [row[0] for row in group if row[4] + 1 >= self.max_attempts]
+        alert_attempts = [(row[0], row[4] + 1) for row in group if row[4] + 1 < self.max_attempts]
+        if given_up:
+            print("  [!] Giving up on " + str(len(given_up)) + " alerts for " + payload["user_email"] + " after "
+                  + str(self.max_attempts) + " attempts")
+            self.outbox.remove(given_up)
+        if alert_attempts:
+            # the group backs off as far as its most tried alert
+            attempts = max(attempts for _, attempts in alert_attempts)
+            delay = get_retry_delay(attempts, self.retry_base_seconds, self.retry_max_seconds)
+            print("  [!] Will try the alert again in " + str(int(delay)) + " seconds")
+            self.outbox.retry_later(alert_attempts, delay)
+
+
+#####################################################################################
+# THESE ARE THE INOTIFY EVENTS THAT MEAN A FILE WAS WRITTEN OR REPLACED
+#####################################################################################
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+#####################################################################################
+# THIS FUNCTION OPENS AN INOTIFY INSTANCE THROUGH LIBC
+# IT RETURNS (LIBC, FILE DESCRIPTOR), OR NONE WHEN INOTIFY IS NOT AVAILABLE
+#####################################################################################
+def open_inotify():
+    if platform.system() != "Linux":
+        return None
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if inotify_fd < 0:
+        return None
+    return libc, inotify_fd
+
+#####################################################################################
+# THIS CLASS WAITS UNTIL ONE OF THE HISTORY DATABASES (OR ITS WRITE AHEAD LOG)
+# IS WRITTEN TO. ON LINUX IT ASKS INOTIFY TO WATCH THE PROFILE DIRECTORIES,
+# EVERYWHERE ELSE IT CHECKS THE SIZE AND MODIFICATION TIME EVERY FEW SECONDS
+#####################################################################################
+class HistoryWatcher:
+    def __init__(self, history_paths, debounce_seconds, poll_seconds=STAT_POLL_SECONDS):
+        self.debounce_seconds = debounce_seconds
+        self.poll_seconds = poll_seconds
+        self.history_paths = set()
+        self.signatures = {}
+        # watch descriptor -> (directory, names of the files we care about in it)
+        self.watches = {}
+        self.inotify = open_inotify()
+        if self.inotify is None:
+            print("  [*] inotify is not available, checking the history files every " + str(poll_seconds) + " seconds")
+        self.update(history_paths)
+
+    # THIS FUNCTION STARTS WATCHING ANY HISTORY DATABASES THAT ARE NEW
+    def update(self, history_paths):
+        for history_path in history_paths:
+            history_path = os.path.abspath(str(history_path))
+            if history_path in self.history_paths:
+                continue
+            self.history_paths.add(history_path)
+            self.signatures[history_path] = get_file_signature(history_path)
+            if self.inotify is not None:
+                self.add_watch(history_path)
+
+    # THIS FUNCTION ADDS THE DATABASE AND ITS LOG TO THE WATCH ON ITS DIRECTORY
+    # THE DIRECTORY IS WATCHED BECAUSE THE LOG FILE COMES AND GOES
+    def add_watch(self, history_path):
+        libc, inotify_fd = self.inotify
+        directory, name = os.path.split(history_path)
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        watch = libc.inotify_add_watch(inotify_fd, os.fsencode(directory), mask)
+        if watch < 0:
+            print("  [!] Could not watch " + directory)
+            return
+        # adding the same directory twice hands back the same watch descriptor
+        names = self.watches.setdefault(watch, (directory, set()))[1]
+        names.add(os.fsencode(name))
+        names.add(os.fsencode(name + "-wal"))
+
+    # THIS FUNCTION WAITS FOR A CHANGE, THEN WAITS FOR THE FILES TO GO QUIET
+    # SO A BURST OF WRITES ONLY TRIGGERS ONE CYCLE
+    # IT RETURNS TRUE IF SOMETHING CHANGED AND FALSE IF THE TIMEOUT RAN OUT
+    def wait_for_change(self, timeout):
+        if not self.wait_for_event(time.monotonic() + timeout):
+            return False
+        # a browser that never stops writing should not hold the cycle back forever
+        settle_deadline = time.monotonic() + self.debounce_seconds * 10
+        while time.monotonic() < settle_deadline:
+            if not self.wait_for_event(min(time.monotonic() + self.debounce_seconds, settle_deadline)):
+                break
+        return True
+
+    # THIS FUNCTION RETURNS TRUE AS SOON AS A WATCHED FILE CHANGES
+    # OR FALSE ONCE THE DEADLINE (FROM time.monotonic) HAS PASSED
+    def wait_for_event(self, deadline):
+        if self.inotify is None:
+            return self.poll_for_event(deadline)
+        inotify_fd = self.inotify[1]
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            ready, _, _ = select.select([inotify_fd], [], [], remaining)
+            if ready and self.read_inotify_events():
+                return True
+
+    # THIS FUNCTION READS THE QUEUED INOTIFY EVENTS AND RETURNS TRUE
+    # IF ANY OF THEM WAS FOR A HISTORY DATABASE OR ITS LOG
+    def read_inotify_events(self):
+        try:
+            data = os.read(self.inotify[1], 65536)
+        except BlockingIOError:
+            return False
+        changed = False
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            watch, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+            # if the queue overflowed we cannot know what changed, so assume everything did
+            if mask & IN_Q_OVERFLOW:
+                changed = True
+            elif watch in self.watches and name in self.watches[watch][1]:
+                changed = True
+        return changed
+
+    # THIS FUNCTION IS THE FALLBACK, IT COMPARES FILE SIZES AND MODIFICATION TIMES
+    def poll_for_event(self, deadline):
+        while True:
+            changed = False
+            for history_path in self.history_paths:
+                signature = get_file_signature(history_path)
+                if signature != self.signatures[history_path]:
+                    self.signatures[history_path] = signature
+                    changed = True
+            if changed:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_seconds, remaining))
+
+#####################################################################################
+# THIS FUNCTION RUNS A CYCLE EVERY TIME A BROWSER WRITES TO ITS HISTORY
+# IF NOTHING CHANGES FOR MAX QUIET INTERVAL MINUTES A CYCLE RUNS ANYWAY
+#####################################################################################
+def run_watcher_loop(cycle_function, max_quiet_interval, debounce_seconds):
+    watcher = HistoryWatcher([history_path for _, _, history_path in get_history_sources()], debounce_seconds)
+    while True:
+        cycle_function()
+        print("  [*] Watching browser history for changes")
+        print("  [*] Press CTRL+C to exit")
+        if not watcher.wait_for_change(max_quiet_interval * 60):
+            print("  [*] No changes for " + str(max_quiet_interval) + " minutes, checking anyway")
+        # pick up profiles that were created while we were waiting
+        watcher.update([history_path for _, _, history_path in get_history_sources()])
+
+#####################################################################################
+# THIS CLASS DECIDES HOW LONG TO WAIT BEFORE THE NEXT CYCLE
+# A MATCH MEANS SOMEONE IS SHOPPING RIGHT NOW, SO THE NEXT CHECK COMES AS SOON AS
+# ALLOWED. NEW HISTORY WITHOUT A MATCH SHORTENS THE WAIT, NO NEW HISTORY AT ALL
+# LENGTHENS IT, SO AN IDLE MACHINE (OVERNIGHT) IS HARDLY CHECKED AT ALL
+# THE JITTER KEEPS MANY MONITORS FROM ALL WAKING UP AT THE SAME MOMENT
+#####################################################################################
+class AdaptiveScheduler:
+    def __init__(self, min_seconds, max_seconds, start_seconds, backoff, jitter):
+        self.min_seconds = min_seconds
+        self.max_seconds = max(min_seconds, max_seconds)
+        self.backoff = max(1, backoff)
+        self.jitter = min(max(0, jitter), 1)
+        self.interval = self.clamp(start_seconds)
+
+    # THIS FUNCTION KEEPS A WAIT BETWEEN THE BOUNDS
+    def clamp(self, seconds):
+        return min(self.max_seconds, max(self.min_seconds, seconds))
+
+    # THIS FUNCTION TAKES WHAT THE LAST CYCLE SAW AND RETURNS (SECONDS TO WAIT, WHY)
+    def next_delay(self, rows, matches):
+        if matches:
+            self.interval = self.min_seconds
+            reason = str(matches) + " matches, checking again as soon as allowed"
+        elif rows:
+            self.interval = self.clamp(self.interval / self.backoff)
+            reason = str(rows) + " new visits, shortening the wait"
+        else:
+            self.interval = self.clamp(self.interval * self.backoff)
+            reason = "no new visits, lengthening the wait"
+        delay = self.clamp(self.interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+        return delay, reason
 
 
 #####################################################################################
@@ -266,72 +1960,68 @@ def find_alerts(my_recent_browser_history, alert_site_list):
 #####################################################################################
 #####################################################################################
 
+# THIS FUNCTION CHECKS A VALUE AGAINST ONE OF THE VALIDATION REGEXES
+def is_valid(value, regex):
+    return value is not None and re.match(regex, value) is not None
+
+
+
+# THIS FUNCTION SPLITS A LIST OF ALERT SITES SEPARATED BY SPACES OR COMMAS
+# AND RETURNS NONE IF ANY OF THEM IS NOT VALID
+def parse_alert_sites(alert_sites, regex):
+    alert_site_list = alert_sites.replace(",", " ").split()
+    for alert in alert_site_list:
+        if not is_valid(alert, regex):
+            return None
+    return alert_site_list
+
+
+
+# THIS FUNCTION KEEPS PROMPTING UNTIL THE ANSWER MATCHES THE REGEX
+# EVERY PROMPT BELOW GOES THROUGH IT SO THEY ALL VALIDATE THE SAME WAY
+def prompt_until_valid(prompt, regex, error_message):
+    while True:
+        answer = input(prompt)
+        if is_valid(answer, regex):
+            return answer
+        print(error_message)
+
+
+
 # THIS FUNCTION PROMPTS THE USER FOR THEIR NAME AND VALIDATES IT
 def get_user_name(regex):
-    # prompt the user for their name
-    user_name = input("\n  Please enter your name -> ")
-    # check to see if the name is valid
-    # if it is valid then return the name
-    # if it is not valid then recurse and start over
-    if re.match(regex, user_name):
-        return user_name
-    else:
-        print("  Invalid name. Please try again.")
-        return get_user_name(regex)
+    return prompt_until_valid("\n  Please enter your name -> ", regex, "  Invalid name. Please try again.")
 
 
 
 # THIS FUNCTION PROMPTS THE USER FOR THEIR EMAIL ADDRESS AND VALIDATES IT
 def get_user_email(regex):
-    # prompt the user for their email address
-    user_email = input("\n  Please enter your email address -> ")
-    # check to see if the email address is valid
-    # if it is valid then return the email address
-    # if it is not valid then recurse and start over
-    if re.match(regex, user_email):
-        return user_email
-    else:
-        print("  Invalid email. Please try again.")
-        return get_user_email(regex)
+    return prompt_until_valid("\n  Please enter your email address -> ", regex, "  Invalid email. Please try again.")
 
 
 
 # THIS FUNCTION PROMPTS THE USER FOR THE SHOPPER NAME AND VALIDATES IT
 def get_shopper_name(regex):
-    # prompt the user for the shopper name
-    shopper_name = input("\n  Please enter the name of the shopper -> ")
-    # check to see if the shopper name is valid
-    # if it is valid then return the shopper name
-    # if it is not valid then recurse and start over
-    if re.match(regex, shopper_name):
-        return shopper_name
-    else:
-        print("  Invalid name. Please try again.")
-        return get_shopper_name(regex)
+    return prompt_until_valid("\n  Please enter the name of the shopper -> ", regex, "  Invalid name. Please try again.")
 
 
 
 # THIS FUNCTION PROMPTS THE USER FOR THE ALERT SITES AND VALIDATES THEM
 def get_alert_site(regex):
-    # prompt the user for the alert sites
-    print("\n  Please enter the name of the sites you")
-    print("  want to be alerted about. If there are")
-    print("  multiple sites, separate them with a space.")
-    alert_site = input("  Or hit enter for default (Amazon) -> ")
-    # if the user does not enter anything then set the alert site to Amazon by default
-    if alert_site == "":
-        return ['Amazon']
-    # if the user enters data, split the input into a list
-    else:
-        alert_site_list = alert_site.split() # parsing the input into a list
-    # check to see that all the items in the list are valid
-    # if an invalid item is found then it will recurse and start over
-    for alert in alert_site_list:
-        if re.match(regex, alert) == False:
-            print("  Invalid input. Please try again.")
-            return get_alert_site(regex)
-    # if all items are valid then return the list
-    return alert_site_list
+    while True:
+        # prompt the user for the alert sites
+        print("\n  Please enter the name of the sites you")
+        print("  want to be alerted about. If there are")
+        print("  multiple sites, separate them with a space.")
+        alert_site = input("  Or hit enter for default (Amazon) -> ")
+        # if the user does not enter anything then set the alert site to Amazon by default
+        if alert_site == "":
+            return ['Amazon']
+        # if every site is valid then return the list, otherwise start over
+        alert_site_list = parse_alert_sites(alert_site, regex)
+        if alert_site_list:
+            return alert_site_list
+        print("  Invalid input. Please try again.")
 
 # THIS FUNCTION CLEANS THE ALERT SITE LIST
 def clean_history_list(this_list):
@@ -348,18 +2038,6 @@ def exit_gracefully():
     clear_terminal()
     sys.exit(0)
 
-#####################################################################################
-#####################################################################################
-#####################################################################################
-# DISPLAY THE SPLASH SCREEN
-#####################################################################################
-#####################################################################################
-#####################################################################################
-try:
-    display_splashscreen()
-except KeyboardInterrupt:
-    exit_gracefully()
-    
 #####################################################################################
 #####################################################################################
 #####################################################################################
@@ -368,15 +2046,17 @@ except KeyboardInterrupt:
 #####################################################################################
 #####################################################################################
 
-# display a nice greeting
-print("\nI just need some information from you before we get started...\n")
+# THIS FUNCTION ASKS FOR EVERYTHING THE MONITOR NEEDS AND HAS THE USER CONFIRM IT
+# IT RETURNS (USER NAME, USER EMAIL, SHOPPER NAME, ALERT SITE LIST)
+def gather_user_input():
+    # display a nice greeting
+    print("\nI just need some information from you before we get started...\n")
 
-# this boolean will be used to determine if the user is satisfied with their input
-# the program will not start processing data until the value is TRUE
-finished_gathering_user_input = False
+    # this boolean will be used to determine if the user is satisfied with their input
+    # the program will not start processing data until the value is TRUE
+    finished_gathering_user_input = False
 
-# This loop will continue until the user is satisfied with their input
-try:
+    # This loop will continue until the user is satisfied with their input
     while finished_gathering_user_input == False:
         #gather user input
         user_name = get_user_name(NAME_REGEX)
@@ -421,56 +2101,572 @@ try:
             finished_gathering_user_input = True
         else:
             clear_terminal() 
-except KeyboardInterrupt:
-    exit_gracefully()
+
+    return user_name, user_email, shopper_name, alert_site_list
+
+
+
+# THIS FUNCTION RETURNS (USER NAME, USER EMAIL, SHOPPER NAME, ALERT SITE LIST) FROM
+# THE CONFIGURATION, OR NONE IF SOMETHING IS MISSING OR INVALID
+# WHAT IS WRONG IS PRINTED WHEN COMPLAIN IS TRUE
+def get_configured_user_input(complain):
+    problems = []
+    if not is_valid(USER_NAME, NAME_REGEX):
+        problems.append("USER_NAME is missing or is not a valid name")
+    if not is_valid(USER_EMAIL, EMAIL_REGEX):
+        problems.append("USER_EMAIL is missing or is not a valid email address")
+    if not is_valid(SHOPPER_NAME, NAME_REGEX):
+        problems.append("SHOPPER_NAME is missing or is not a valid name")
+    alert_site_list = parse_alert_sites(ALERT_SITES or "", WEBSITE_REGEX)
+    if not alert_site_list:
+        problems.append("ALERT_SITES is missing or contains an invalid site")
+
+    if problems:
+        if complain:
+            for problem in problems:
+                print("  [!] " + problem)
+        return None
+    return USER_NAME, USER_EMAIL, SHOPPER_NAME, clean_history_list(alert_site_list)
+
+
+# THIS FUNCTION BUILDS ONE ALERT PROFILE, A DICTIONARY WITH WHO TO ALERT, ABOUT WHOM,
+# WHICH SITES AND HOW LONG TO KEEP A SITE QUIET AFTER AN ALERT
+# THE SUPPRESSION SETTINGS DEFAULT TO SUPPRESSION_WINDOW AND SITE_SUPPRESSION_WINDOWS
+def make_alert_profile(name, user_name, user_email, shopper_name, alert_site_list,
+                       suppression_window=None, site_windows=None):
+    return {
+        "name": name,
+        "user_name": user_name,
+        "user_email": user_email,
+        "shopper_name": shopper_name,
+        "alert_sites": clean_history_list(list(alert_site_list)),
+        "suppression_window": SUPPRESSION_WINDOW if suppression_window is None else suppression_window,
+        "site_windows": parse_site_windows(SITE_SUPPRESSION_WINDOWS) if site_windows is None else site_windows,
+    }
+
+
+# THIS FUNCTION READS THE PROFILES FILE AND RETURNS A LIST OF ALERT PROFILES
+# IT RETURNS NONE (AFTER SAYING WHY) IF THE FILE OR ANY PROFILE IN IT IS BROKEN
+def load_alert_profiles(path):
+    try:
+        with open(path) as profiles_file:
+            entries = json.load(profiles_file)
+    except (OSError, ValueError) as e:
+        print("  [!] Could not read the profiles file " + path + ": %s" % e)
+        return None
+    if not isinstance(entries, list) or not entries:
+        print("  [!] The profiles file must hold a list of profiles")
+        return None
+
+    profiles = []
+    problems = []
+    for number, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict):
+            problems.append("profile " + str(number) + " is not an object")
+            continue
+        name = str(entry.get("name") or "profile " + str(number))
+        if name in [profile["name"] for profile in profiles]:
+            problems.append("there are two profiles called " + name)
+
+        # the same rules as the prompts and the single profile settings
+        entry_problems = []
+        for key, regex in (("user_name", NAME_REGEX), ("user_email", EMAIL_REGEX), ("shopper_name", NAME_REGEX)):
+            if not isinstance(entry.get(key), str) or not is_valid(entry[key], regex):
+                entry_problems.append(key + " is missing or not valid")
+        alert_sites = entry.get("alert_sites")
+        if isinstance(alert_sites, list):
+            alert_sites = " ".join(str(site) for site in alert_sites)
+        alert_site_list = parse_alert_sites(alert_sites if isinstance(alert_sites, str) else "", WEBSITE_REGEX)
+        if not alert_site_list:
+            entry_problems.append("alert_sites is missing or contains an invalid site")
+        suppression_window = entry.get("suppression_window")
+        if suppression_window is not None and (isinstance(suppression_window, bool) or
+                                               not isinstance(suppression_window, (int, float))):
+            entry_problems.append("suppression_window must be a number of minutes")
+        site_windows = entry.get("site_suppression_windows")
+        if site_windows is not None and not isinstance(site_windows, str):
+            entry_problems.append("site_suppression_windows must look like \"amazon=60,ebay=5\"")
+
+        if entry_problems:
+            problems += ["profile " + name + ": " + problem for problem in entry_problems]
+            continue
+        profiles.append(make_alert_profile(name, entry["user_name"], entry["user_email"], entry["shopper_name"],
+                                           alert_site_list, suppression_window,
+                                           None if site_windows is None else parse_site_windows(site_windows)))
+
+    if problems:
+        for problem in problems:
+            print("  [!] " + problem)
+        return None
+    return profiles
+
+
+
+# THESE FUNCTIONS REMEMBER THAT THE CONSENT NOTICE WAS ACCEPTED
+# SO IT ONLY HAS TO BE ACCEPTED ONCE, NOT AFTER EVERY RESTART
+def has_recorded_consent():
+    return os.path.exists(CONSENT_FILE)
+
+def record_consent():
+    os.makedirs(os.path.dirname(CONSENT_FILE), exist_ok=True)
+    with open(CONSENT_FILE, "w") as consent_file:
+        consent_file.write("consent acknowledged " + datetime.now(timezone.utc).isoformat() + "\n")
 
 
 #####################################################################################
 #####################################################################################
 #####################################################################################
-# Start the Brevo API
+# INSTRUMENTATION
 #####################################################################################
 #####################################################################################
 #####################################################################################
 
-# clear the terminal so that the program is purdier
-clear_terminal()
-print("  [*] Starting Brevo API...")
+#####################################################################################
+# THIS CLASS KEEPS THE NUMBERS ABOUT WHAT THE MONITOR HAS BEEN DOING
+# COUNTERS ONLY GO UP, GAUGES HOLD THE LATEST VALUE, AND THE CYCLE HISTOGRAM COUNTS
+# HOW MANY CYCLES FINISHED WITHIN EACH LATENCY BUCKET
+# EVERY VALUE CAN CARRY LABELS (LIKE source="Chrome:Default")
+# THE DELIVERY THREAD WRITES TO IT TOO, SO EVERYTHING GOES THROUGH A LOCK
+#####################################################################################
+class Metrics:
+    def __init__(self, buckets=CYCLE_LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        # (name, ((label, value), ...)) -> number
+        self.counters = {}
+        self.gauges = {}
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.cycle_count = 0
+        self.cycle_seconds_sum = 0.0
+
+    # THIS FUNCTION ADDS TO A COUNTER
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    # THIS FUNCTION SETS A GAUGE
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    # THIS FUNCTION TIMES WHATEVER RUNS INSIDE "with metrics.timer(stage):"
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - start)
+
+    # THIS FUNCTION ADDS THE TIME OF A STAGE THAT WAS MEASURED SOMEWHERE ELSE
+    def record_stage(self, stage, seconds):
+        self.count("stage_seconds_total", seconds, stage=stage)
+        self.set_gauge("stage_last_seconds", seconds, stage=stage)
+
+    # THIS FUNCTION ADDS A FINISHED CYCLE TO THE LATENCY HISTOGRAM
+    def observe_cycle(self, seconds):
+        with self.lock:
+            self.cycle_count += 1
+            self.cycle_seconds_sum += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self.bucket_counts[i] += 1
+
+    # THIS FUNCTION RETURNS THE CURRENT VALUE OF A COUNTER (ALL LABELS ADDED UP)
+    def total(self, name):
+        with self.lock:
+            return sum(value for (counter, _), value in self.counters.items() if counter == name)
+
+    # THIS FUNCTION RETURNS THE LATEST VALUE OF EVERY GAUGE WITH THIS NAME, BY LABEL
+    def gauge_values(self, name, label):
+        with self.lock:
+            return {dict(labels).get(label): value for (gauge, labels), value in self.gauges.items() if gauge == name}
+
+    # THIS FUNCTION WRITES EVERYTHING OUT IN THE PROMETHEUS TEXT FORMAT
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                last_name = None
+                for (name, labels), value in sorted(values.items()):
+                    if name != last_name:
+                        lines.append("# TYPE shopsnitch_" + name + " " + kind)
+                        last_name = name
+                    lines.append("shopsnitch_" + name + format_prometheus_labels(labels) + " " + repr(float(value)))
+
+            lines.append("# TYPE shopsnitch_cycle_seconds histogram")
+            for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+                lines.append('shopsnitch_cycle_seconds_bucket{le="' + repr(float(bound)) + '"} ' + str(bucket_count))
+            lines.append('shopsnitch_cycle_seconds_bucket{le="+Inf"} ' + str(self.cycle_count))
+            lines.append("shopsnitch_cycle_seconds_sum " + repr(self.cycle_seconds_sum))
+            lines.append("shopsnitch_cycle_seconds_count " + str(self.cycle_count))
+        return "\n".join(lines) + "\n"
 
-# initialize the global api instance
-global_api_instance = configure_brevo_api(API_KEY)
-print("  [*] Brevo API started successfully")
+#####################################################################################
+# THIS FUNCTION TURNS ((label, value), ...) INTO {label="value",...}
+#####################################################################################
+def format_prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = []
+    for label, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(label + '="' + value + '"')
+    return "{" + ",".join(escaped) + "}"
 
+#####################################################################################
+# THIS FUNCTION SERVES THE METRICS ON http://127.0.0.1:PORT/metrics FROM A
+# BACKGROUND THREAD AND RETURNS THE SERVER SO IT CAN BE SHUT DOWN
+#####################################################################################
+def start_metrics_server(metrics, port):
+    # only loaded when the endpoint is turned on
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # keep the request log out of the monitor output
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print("  [*] Serving metrics on http://127.0.0.1:" + str(port) + "/metrics")
+    return server
 
 
 #####################################################################################
 #####################################################################################
 #####################################################################################
-# Test functions to make sure things are working before setting timer
+# THE MONITOR
 #####################################################################################
 #####################################################################################
 #####################################################################################
 
-def main_function():
-    # get the most recent slice of history
-    current_history = get_browser_history(TIME_INTERVAL)
-    # find the alerts in current history
-    current_matches = find_alerts(current_history, alert_site_list)
-    # if there are any matches then send an alert
-    if current_matches != []:
-        print("  [*] Initializing alert system")
-        send_alert(global_api_instance, current_matches, shopper_name, user_name, user_email, FROM_EMAIL)
+#####################################################################################
+# THIS CLASS HOLDS EVERYTHING THAT LIVES FROM ONE CYCLE TO THE NEXT
+# THE NOTIFIER, THE WATERMARKS, THE PROFILES AND THEIR MATCHER, THE LEDGER AND THE
+# DELIVERY THREAD
+#####################################################################################
+class Monitor:
+    def __init__(self, profiles):
+        # time and count everything from the start
+        self.metrics = Metrics()
+        self.metrics_server = None
+        if METRICS_PORT:
+            self.metrics_server = start_metrics_server(self.metrics, METRICS_PORT)
+
+        # initialize the notifier
+        print("  [*] Starting notifier...")
+        self.notifier = configure_notifier(NOTIFIER)
+        print("  [*] Notifier started successfully")
+
+        # pick up where the last run left off
+        self.history_watermarks = load_watermarks(WATERMARK_FILE)
+        self.history_collector = HistoryCollector(HISTORY_WORKERS, SOURCE_TIMEOUT)
+
+        # build the matcher for every profile once, it is reused every cycle
+        self.alert_profiles = AlertProfiles(profiles, MATCH_MODE)
+
+        # open the record of what has already been alerted about
+        self.alert_ledger = AlertLedger(STATE_DATABASE)
+
+        # start sending alerts in the background, including any left over from last time
+        self.alert_renderer = AlertRenderer(FROM_EMAIL, DIGEST_CYCLES)
+        alert_outbox = AlertOutbox(STATE_DATABASE)
+        if alert_outbox.count() > 0:
+            print("  [*] " + str(alert_outbox.count()) + " alerts from the last run are still waiting to be sent")
+        self.delivery_worker = AlertDeliveryWorker(alert_outbox, self.deliver_alert, COALESCE_SECONDS,
+                                                   MAX_SEND_ATTEMPTS, RETRY_BASE_SECONDS, RETRY_MAX_SECONDS,
+                                                   DIGEST_CYCLES)
+        self.delivery_worker.start()
+
+    # THIS FUNCTION SENDS ONE ALERT FROM THE OUTBOX THROUGH THE NOTIFIER
+    def deliver_alert(self, payload):
+        try:
+            with self.metrics.timer("send_alert"):
+                sent = send_alert(self.notifier, self.alert_renderer, payload)
+        except Exception:
+            self.metrics.count("send_failures_total")
+            raise
+        self.metrics.count("alerts_sent_total" if sent else "send_failures_total")
+        return sent
+
+    # THIS FUNCTION RUNS ONE CYCLE, READ THE NEW HISTORY, MATCH IT AND QUEUE ALERTS
+    # IT RETURNS (ROWS READ, MATCHES FOUND) SO THE SCHEDULER CAN SEE WHAT HAPPENED
+    def main_function(self):
+        cycle_start = time.perf_counter()
+        # the cycle works on a copy of the watermarks and only keeps it once everything
+        # is saved, so a cycle that fails or is interrupted is read again from the start
+        history_watermarks = dict(self.history_watermarks)
+        try:
+            # stream the history we have not looked at yet through the matcher and the ledger
+            # the ledger leaves out visits that were already alerted about, the stream stops
+            # early once every site of every profile has matched (unless a digest is counting)
+            cancel_event = threading.Event()
+            history_stream = stream_browser_history(TIME_INTERVAL, history_watermarks, self.metrics,
+                                                    self.history_collector, cancel_event, BATCH_MODE)
+            with self.metrics.timer("scan"), contextlib.closing(history_stream):
+                site_visits, row_count, hit_count = scan_history(history_stream, self.alert_profiles.matcher,
+                                                               self.alert_ledger, cancel_event,
+                                                               stop_early=not DIGEST_CYCLES, metrics=self.metrics)
+            # every profile that is watching one of the sites gets its own alert, unless
+            # it is keeping those sites quiet. the delivery thread sends them
+            alerts_queued = 0
+            for profile, profile_sites in self.alert_profiles.split_by_profile(list(site_visits)):
+                current_matches = self.alert_ledger.filter_suppressed(profile, profile_sites)
+                if current_matches == []:
+                    continue
+                print("  [*] Queueing alert for " + profile["user_name"] + " at " + profile["user_email"])
+                self.delivery_worker.queue_alert({"sites": current_matches, "shopper_name": profile["shopper_name"],
+                                                  "user_name": profile["user_name"], "user_email": profile["user_email"],
+                                                  "profile": profile["name"],
+                                                  "visits": {site: site_visits[site] for site in current_matches}},
+                                                 self.alert_ledger.connection)
+                self.alert_ledger.mark_alerted(profile["name"], current_matches)
+                self.metrics.count("alerts_queued_total", len(current_matches), profile=profile["name"])
+                alerts_queued += len(current_matches)
+            # the hits, the suppression marks and the queued alerts are saved in one go,
+            # so a cycle that stops halfway never keeps the hits without the alerts
+            self.alert_ledger.save_hits()
+        except BaseException:
+            self.alert_ledger.forget_hits()
+            raise
+        if alerts_queued == 0:
+            print("  [*] No alerts will be sent at this time")
+        else:
+            self.delivery_worker.wake()
+        # remember how far we got so the next cycle only reads newer visits
+        save_watermarks(WATERMARK_FILE, history_watermarks)
+        self.history_watermarks = history_watermarks
+
+        cycle_seconds = time.perf_counter() - cycle_start
+        self.metrics.count("cycles_total")
+        self.metrics.count("matches_total", hit_count)
+        self.metrics.observe_cycle(cycle_seconds)
+        if METRICS_LOG:
+            self.log_cycle(cycle_seconds, row_count, hit_count, alerts_queued)
+        self.delivery_worker.end_cycle()
+        return row_count, hit_count
+
+    # THIS FUNCTION RUNS ONE CYCLE AND TRIES IT AGAIN IF IT FAILS, SO ONE BAD CYCLE
+    # NEVER STOPS THE MONITOR. A CYCLE THAT KEEPS FAILING IS SKIPPED, NOTHING IS LOST
+    # BECAUSE THE NEXT ONE STARTS FROM THE LAST SAVED WATERMARKS
+    def run_cycle(self):
+        for attempt in range(CYCLE_RETRIES + 1):
+            try:
+                return self.main_function()
+            except Exception as e:
+                self.metrics.count("cycle_failures_total")
+                print("  [!] The cycle failed: %r" % e)
+                if attempt == CYCLE_RETRIES:
+                    break
+                delay = get_retry_delay(attempt, CYCLE_RETRY_SECONDS, CYCLE_RETRY_SECONDS * 2 ** CYCLE_RETRIES)
+                print("  [!] Will try the cycle again in " + str(int(delay)) + " seconds")
+                time.sleep(delay)
+        print("  [!] Skipping this cycle after " + str(CYCLE_RETRIES + 1) + " attempts, the next one starts where it left off")
+        return 0, 0
+
+    # THIS FUNCTION PRINTS ONE LINE OF JSON DESCRIBING THE CYCLE THAT JUST FINISHED
+    def log_cycle(self, cycle_seconds, rows, matches, alerts_queued):
+        print(json.dumps({
+            "event": "cycle",
+            "time": datetime.now(timezone.utc).isoformat(),
+            "cycle_seconds": round(cycle_seconds, 6),
+            "stage_seconds": {stage: round(seconds, 6) for stage, seconds in self.metrics.gauge_values("stage_last_seconds", "stage").items()},
+            "source_seconds": {source: round(seconds, 6) for source, seconds in self.metrics.gauge_values("source_last_read_seconds", "source").items()},
+            "rows": rows,
+            "matches": matches,
+            "alerts_queued": alerts_queued,
+            "alerts_sent_total": self.metrics.total("alerts_sent_total"),
+            "send_failures_total": self.metrics.total("send_failures_total"),
+        }, sort_keys=True))
+
+    # THIS FUNCTION RUNS CYCLES FOREVER
+    def run(self):
+        # either wake up when the browser history changes
+        if WATCH_HISTORY:
+            run_watcher_loop(self.run_cycle, MAX_QUIET_INTERVAL, DEBOUNCE_SECONDS)
+        # or wake up sooner or later depending on what the last cycle saw
+        elif ADAPTIVE_SCHEDULE:
+            scheduler = AdaptiveScheduler(MIN_INTERVAL_SECONDS, MAX_INTERVAL_SECONDS, TIME_INTERVAL * 60,
+                                          SCHEDULE_BACKOFF, SCHEDULE_JITTER)
+            while True:
+                row_count, hit_count = self.run_cycle()
+                delay, reason = scheduler.next_delay(row_count, hit_count)
+                self.metrics.set_gauge("schedule_delay_seconds", delay)
+                print("  [*] Sleeping for " + str(round(delay)) + " seconds (" + reason + ")")
+                if METRICS_LOG:
+                    print(json.dumps({"event": "schedule", "time": datetime.now(timezone.utc).isoformat(),
+                                      "delay_seconds": round(delay, 3), "rows": row_count,
+                                      "matches": hit_count, "reason": reason}, sort_keys=True))
+                print("  [*] Press CTRL+C to exit")
+                time.sleep(delay)
+        # or wake up every time interval
+        else:
+            while True:
+                # run the main function
+                self.run_cycle()
+                # sleep for the specified time interval
+                print("  [*] Sleeping for " + str(TIME_INTERVAL) + " minutes")
+                print("  [*] Press CTRL+C to exit")
+                # sleep for the specified time interval
+                time.sleep(TIME_INTERVAL * 60)
+
+    # THIS FUNCTION LETS AN ALERT THAT IS BEING SENT RIGHT NOW FINISH, CLOSES THE NOTIFIER
+    # AND STOPS THE HISTORY THREADS
+    # THE WATERMARKS, THE LEDGER AND THE OUTBOX ARE ALREADY ON DISK AFTER EVERY CYCLE, A
+    # CYCLE THAT WAS INTERRUPTED LEFT NOTHING BEHIND AND IS READ AGAIN NEXT TIME
+    def stop(self):
+        self.delivery_worker.stop()
+        self.notifier.close()
+        self.history_collector.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        waiting = self.delivery_worker.outbox.count()
+        if waiting > 0:
+            print("  [*] " + str(waiting) + " alerts are saved and will be sent the next time the program starts")
+        print("  [*] Stopped, the next run picks up where this one left off")
+
+
+#####################################################################################
+#####################################################################################
+#####################################################################################
+# START THE PROGRAM
+#####################################################################################
+#####################################################################################
+#####################################################################################
+#####################################################################################
+# THIS FUNCTION READS THE COMMAND LINE
+# ANYTHING GIVEN HERE WINS OVER THE ENVIRONMENT AND THE CONFIG FILE
+#####################################################################################
+def parse_arguments(arguments=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Sends an email when a shopping site shows up in the browser history.")
+    parser.add_argument("--config", help="read settings from this file (same format as .env)")
+    parser.add_argument("--headless", action="store_true",
+                        help="never prompt, exit if a setting is missing (for running as a service)")
+    parser.add_argument("--acknowledge-consent", action="store_true",
+                        help="accept the consent notice without showing the splash screen")
+    parser.add_argument("--user-name", help="your name")
+    parser.add_argument("--user-email", help="the address alerts are sent to")
+    parser.add_argument("--shopper-name", help="the name of the shopper")
+    parser.add_argument("--alert-sites", help="the sites to alert about, separated by spaces or commas")
+    parser.add_argument("--profiles", help="read several alert profiles from this JSON file (see PROFILES_FILE)")
+    return parser.parse_args(arguments)
+
+
+#####################################################################################
+# THIS FUNCTION MAKES SIGTERM (A SERVICE MANAGER OR kill STOPPING THE PROGRAM) SHUT
+# DOWN THE SAME WAY AS CTRL+C, INSTEAD OF ENDING THE PROGRAM ON THE SPOT
+#####################################################################################
+def handle_termination_signals():
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+#####################################################################################
+# THIS FUNCTION IGNORES SIGTERM AND CTRL+C WHILE THE PROGRAM IS SHUTTING DOWN, SO
+# ASKING TWICE DOES NOT CUT THE SHUTDOWN SHORT
+#####################################################################################
+def ignore_termination_signals():
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+#####################################################################################
+# THIS FUNCTION PUTS THE COMMAND LINE VALUES ON TOP OF THE LOADED SETTINGS
+#####################################################################################
+def apply_arguments(arguments):
+    global USER_NAME, USER_EMAIL, SHOPPER_NAME, ALERT_SITES, CONSENT_ACKNOWLEDGED, PROFILES_FILE
+    if arguments.user_name is not None:
+        USER_NAME = arguments.user_name
+    if arguments.user_email is not None:
+        USER_EMAIL = arguments.user_email
+    if arguments.shopper_name is not None:
+        SHOPPER_NAME = arguments.shopper_name
+    if arguments.alert_sites is not None:
+        ALERT_SITES = arguments.alert_sites
+    if arguments.acknowledge_consent:
+        CONSENT_ACKNOWLEDGED = True
+    if arguments.profiles is not None:
+        PROFILES_FILE = arguments.profiles
+
+
+def main():
+    arguments = parse_arguments()
+    load_configuration(arguments.config)
+    apply_arguments(arguments)
+
+    # the consent notice only has to be accepted once
+    # after that (or when it was accepted in the settings) the splash screen is skipped
+    if CONSENT_ACKNOWLEDGED and not has_recorded_consent():
+        record_consent()
+    if not has_recorded_consent():
+        if arguments.headless:
+            print("  [!] The consent notice has not been accepted yet")
+            print("  [!] Run once without --headless, or set CONSENT_ACKNOWLEDGED=1")
+            sys.exit(2)
+        # display the splash screen
+        try:
+            display_splashscreen()
+        except KeyboardInterrupt:
+            exit_gracefully()
+        record_consent()
+
+    # a profiles file replaces the single profile settings and the prompts
+    if PROFILES_FILE is not None:
+        profiles = load_alert_profiles(PROFILES_FILE)
+        if profiles is None:
+            sys.exit(2)
+        print("  [*] Loaded " + str(len(profiles)) + " alert profiles from " + PROFILES_FILE)
     else:
-        print("  [*] No alerts will be sent at this time")
+        # use the configured values if they are all there, otherwise ask for them
+        configured_user_input = get_configured_user_input(complain=arguments.headless)
+        if configured_user_input is not None:
+            user_name, user_email, shopper_name, alert_site_list = configured_user_input
+        elif arguments.headless:
+            sys.exit(2)
+        else:
+            # gather user input
+            try:
+                user_name, user_email, shopper_name, alert_site_list = gather_user_input()
+            except KeyboardInterrupt:
+                exit_gracefully()
+            # clear the terminal so that the program is purdier
+            clear_terminal()
+        profiles = [make_alert_profile(DEFAULT_PROFILE, user_name, user_email, shopper_name, alert_site_list)]
+
+    # from here on SIGTERM stops the program the same way as CTRL+C
+    # nothing has to be cleaned up if it comes while the monitor is still starting,
+    # everything it saves is written in one go
+    handle_termination_signals()
+    try:
+        monitor = Monitor(profiles)
+    except KeyboardInterrupt:
+        if arguments.headless:
+            sys.exit(0)
+        exit_gracefully()
 
-try:
-    while True:
-        # run the main function
-        main_function()
-        # sleep for the specified time interval
-        print("  [*] Sleeping for " + str(TIME_INTERVAL) + " minutes")
-        print("  [*] Press CTRL+C to exit")
-        # sleep for the specified time interval
-        time.sleep(TIME_INTERVAL * 60)
-except KeyboardInterrupt:
-    exit_gracefully()
+    try:
+        monitor.run()
+    except KeyboardInterrupt:
+        ignore_termination_signals()
+        monitor.stop()
+        if arguments.headless:
+            sys.exit(0)
+        exit_gracefully()
+
+
+if __name__ == "__main__":
+    main()
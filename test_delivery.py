@@ -0,0 +1,139 @@
+#####################################################################################
+# THESE TESTS CHECK THE OUTBOX AND THE DELIVERY THREAD AGAINST A FAKE SEND FUNCTION
+# NOTHING IS SENT AND NO BROWSER IS NEEDED, ONLY THE STANDARD LIBRARY
+#
+# RUN THEM FROM THE REPOSITORY WITH
+#     python -m unittest test_delivery
+# (OR python -m pytest test_delivery.py IF PYTEST IS INSTALLED)
+#####################################################################################
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import main
+
+
+#####################################################################################
+# THIS CLASS STANDS IN FOR A NOTIFIER, IT RECORDS EVERY PAYLOAD AND RETURNS WHATEVER
+# IT WAS TOLD TO
+#####################################################################################
+class FakeSend:
+    def __init__(self, results=True):
+        self.results = results
+        self.payloads = []
+
+    def __call__(self, payload):
+        self.payloads.append(payload)
+        return self.results
+
+
+def make_payload(sites, user_email="al@example.com", shopper_name="Bob"):
+    return {"sites": sites, "shopper_name": shopper_name, "user_name": "Al", "user_email": user_email}
+
+
+class DeliveryTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.outbox = main.AlertOutbox(os.path.join(self.state_dir.name, "state.db"))
+        # the worker prints every decision, keep it out of the test output
+        self.quiet = contextlib.redirect_stdout(io.StringIO())
+        self.quiet.__enter__()
+
+    def tearDown(self):
+        self.quiet.__exit__(None, None, None)
+        self.outbox.connection.close()
+        self.state_dir.cleanup()
+
+    def make_worker(self, send_function, coalesce_seconds=0, max_attempts=3):
+        return main.AlertDeliveryWorker(self.outbox, send_function, coalesce_seconds, max_attempts, 5, 60)
+
+    # THIS FUNCTION DELIVERS EVERYTHING THAT IS READY, THE WAY ONE PASS OF THE THREAD DOES
+    def deliver_ready(self, worker, coalesce_seconds=0):
+        ready_groups, _ = self.outbox.take_ready(coalesce_seconds)
+        for group in ready_groups:
+            worker.deliver(group)
+        return len(ready_groups)
+
+    def rows(self):
+        return self.outbox.connection.execute(
+            "SELECT id, payload, attempts, next_attempt FROM alert_outbox ORDER BY id").fetchall()
+
+    def test_alerts_for_one_recipient_are_coalesced(self):
+        send = FakeSend()
+        worker = self.make_worker(send)
+        self.outbox.add(make_payload(["amazon"]))
+        self.outbox.add(make_payload(["ebay", "amazon"]))
+        self.outbox.add(make_payload(["etsy"], shopper_name="Carol"))
+
+        # nothing is ready until the oldest alert has waited the coalesce window
+        self.assertEqual(self.outbox.take_ready(60)[0], [])
+
+        self.assertEqual(self.deliver_ready(worker), 2)
+        self.assertEqual(sorted(payload["sites"] for payload in send.payloads), [["amazon", "ebay"], ["etsy"]])
+        self.assertEqual(self.outbox.count(), 0)
+
+    def test_failed_send_backs_off(self):
+        send = FakeSend(results=False)
+        worker = self.make_worker(send)
+        self.outbox.add(make_payload(["amazon"]))
+
+        before = time.time()
+        self.deliver_ready(worker)
+        (_, _, attempts, next_attempt), = self.rows()
+        self.assertEqual(attempts, 1)
+        # the first retry waits between half and all of base * 2
+        self.assertGreaterEqual(next_attempt, before + 5)
+        self.assertLessEqual(next_attempt, time.time() + 10)
+        # and it is not tried again before then
+        self.assertEqual(self.deliver_ready(worker), 0)
+
+    def test_retry_delay_doubles_up_to_the_ceiling(self):
+        for attempts in range(10):
+            ceiling = min(60, 5 * 2 ** attempts)
+            delay = main.get_retry_delay(attempts, 5, 60)
+            self.assertGreaterEqual(delay, ceiling / 2)
+            self.assertLessEqual(delay, ceiling)
+
+    def test_gives_up_after_max_attempts(self):
+        send = FakeSend(results=False)
+        worker = self.make_worker(send, max_attempts=3)
+        self.outbox.add(make_payload(["amazon"]))
+        for _ in range(3):
+            self.outbox.connection.execute("UPDATE alert_outbox SET next_attempt = 0")
+            self.outbox.connection.commit()
+            self.deliver_ready(worker)
+        self.assertEqual(len(send.payloads), 3)
+        self.assertEqual(self.outbox.count(), 0)
+
+    def test_new_alert_keeps_its_own_attempts(self):
+        send = FakeSend(results=False)
+        worker = self.make_worker(send, max_attempts=3)
+        self.outbox.add(make_payload(["amazon"]))
+        self.outbox.connection.execute("UPDATE alert_outbox SET attempts = 2, next_attempt = 0")
+        self.outbox.connection.commit()
+        # a new alert for the same recipient joins the group on its last attempt
+        self.outbox.add(make_payload(["ebay"]))
+
+        self.deliver_ready(worker)
+        self.assertEqual(send.payloads[0]["sites"], ["amazon", "ebay"])
+        # only the old alert is given up on, the new one has used one attempt
+        (_, payload, attempts, _), = self.rows()
+        self.assertEqual(json.loads(payload)["sites"], ["ebay"])
+        self.assertEqual(attempts, 1)
+
+    def test_sent_alert_is_removed_once(self):
+        send = FakeSend()
+        worker = self.make_worker(send)
+        self.outbox.add(make_payload(["amazon"]))
+        self.deliver_ready(worker)
+        self.deliver_ready(worker)
+        self.assertEqual(len(send.payloads), 1)
+        self.assertEqual(self.outbox.count(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()